@@ -0,0 +1,75 @@
+"""
+Benchmark for splitting the frontmatter from the content of large files.
+
+Compares the single-scan splitting used by EscapeCode with the former
+approach that ran the frontmatter regular expression three times,
+on files with a closed frontmatter, with an unclosed delimiter,
+and without frontmatter.
+
+Usage::
+
+    $ python3 benchmarks/frontmatter_split.py [--size MB] [--repeat N]
+"""
+
+import re
+
+from argparse import ArgumentParser
+from time import perf_counter
+
+from foliant.preprocessors.escapecode import Preprocessor
+
+
+FORMER_FRONTMATTER_PATTERN = re.compile(r'^((-|\+){3})\n([\s\S]+?)\n((-|\+){3})([\s\S]*)')
+
+
+def split_former(markdown_content: str) -> tuple or None:
+    """Split the frontmatter as EscapeCode did before, with three regex substitutions."""
+
+    if not (markdown_content.startswith('---') or markdown_content.startswith('+++')):
+        return None
+
+    frontmatter = FORMER_FRONTMATTER_PATTERN.sub(lambda m: m.group(3), markdown_content)
+    content = FORMER_FRONTMATTER_PATTERN.sub(lambda m: m.group(6), markdown_content)
+    format = FORMER_FRONTMATTER_PATTERN.sub(lambda m: m.group(1), markdown_content)
+
+    return format, frontmatter, content
+
+
+def measure(function, markdown_content: str, repeat: int) -> float:
+    timings = []
+
+    for _ in range(repeat):
+        start_time = perf_counter()
+        function(markdown_content)
+        timings.append(perf_counter() - start_time)
+
+    return min(timings)
+
+
+def main():
+    parser = ArgumentParser(description='Measure frontmatter splitting on large files.')
+    parser.add_argument('--size', type=float, default=8, help='Size of the body in MB')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per case')
+    args = parser.parse_args()
+
+    paragraph = 'Lorem ipsum dolor sit amet, `consectetur` adipisicing elit.\n\n'
+    body = paragraph * int(args.size * 1024 * 1024 / len(paragraph))
+    frontmatter = 'title: Test\ndescription: Lorem ipsum\n'
+
+    cases = {
+        'closed frontmatter': f'---\n{frontmatter}---\n\n{body}',
+        'unclosed delimiter': f'---\n{frontmatter}\n{body}',
+        'no frontmatter': body,
+    }
+
+    print(f'{"case":<20} {"former, ms":>12} {"single scan, ms":>16}')
+
+    for case, markdown_content in cases.items():
+        former_time = measure(split_former, markdown_content, args.repeat)
+        current_time = measure(Preprocessor._split_frontmatter, markdown_content, args.repeat)
+
+        print(f'{case:<20} {former_time * 1000:>12.2f} {current_time * 1000:>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Import-time benchmark for the EscapeCode and UnescapeCode preprocessors.
+
+Runs ``python -X importtime`` in a fresh interpreter for each module
+and reports the cumulative import time and whether Marko was loaded.
+
+Usage::
+
+    $ python3 benchmarks/import_time.py [--repeat N]
+"""
+
+import re
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+from statistics import median
+
+
+MODULES = (
+    'foliant.preprocessors.escapecode',
+    'foliant.preprocessors.unescapecode',
+)
+
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(?P<self>\d+)\s+\|\s+(?P<cumulative>\d+)\s+\|(?P<name>.*)$')
+
+
+def measure(module: str) -> (int, bool):
+    """Import the module in a fresh interpreter with ``-X importtime``.
+
+    :param module: Dotted module name
+
+    :returns: Cumulative import time of the module in microseconds,
+        and the flag that shows whether Marko was imported
+    """
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    )
+
+    cumulative = 0
+    marko_loaded = False
+
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+
+        if not match:
+            continue
+
+        name = match.group('name').strip()
+
+        if name == 'marko':
+            marko_loaded = True
+
+        if name == module:
+            cumulative = int(match.group('cumulative'))
+
+    return cumulative, marko_loaded
+
+
+def main():
+    parser = ArgumentParser(description='Measure import time of the preprocessors.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs per module')
+    args = parser.parse_args()
+
+    for module in MODULES:
+        timings = []
+
+        for _ in range(args.repeat):
+            cumulative, marko_loaded = measure(module)
+            timings.append(cumulative)
+
+        print(
+            f'{module}: median {median(timings) / 1000:.1f} ms, ' +
+            f'min {min(timings) / 1000:.1f} ms, marko loaded: {marko_loaded}'
+        )
+
+
+if __name__ == '__main__':
+    main()
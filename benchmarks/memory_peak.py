@@ -0,0 +1,181 @@
+"""
+Peak memory benchmark for EscapeCode and UnescapeCode.
+
+Escapes generated documents of growing size and reports the peak memory
+allocated by Python, measured with tracemalloc, per MB of input. Then applies
+both preprocessors to a generated project and reports the peak memory per MB
+of the project, and the memory that the daemon's EscapeCode keeps between
+builds with and without the ``lean_memory`` option.
+
+Usage::
+
+    $ python3 benchmarks/memory_peak.py [--files N]
+"""
+
+import tracemalloc
+
+from argparse import ArgumentParser
+from logging import getLogger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from foliant.preprocessors import escapecode, unescapecode
+from foliant.preprocessors._escapecode_daemon import _create_preprocessor_classes
+
+
+def generate_document(sections: int, seed: int = 0) -> str:
+    """Generate a Markdown document with ``sections`` sections, each containing
+    a paragraph with inline code, a nested list, a fence block and a pre block.
+
+    :param sections: Number of sections
+    :param seed: Number that makes the code of the document unique
+
+    :returns: Markdown content
+    """
+
+    lines = []
+
+    for section in range(sections):
+        lines.extend(
+            (
+                f'# Section {seed}.{section}',
+                '',
+                f'Paragraph with `inline_{seed}_{section}` and some text around it.',
+                '',
+                f'- item with `code_{seed}_{section}`',
+                '  - nested item',
+                '    > quoted text',
+                '',
+                '```python',
+                f'def function_{seed}_{section}():',
+                f'    return {section}',
+                '```',
+                '',
+                f'    pre block line {seed}.{section}',
+                '    another pre block line',
+                ''
+            )
+        )
+
+    return '\n'.join(lines) + '\n'
+
+
+def measure_peak(function, *args) -> tuple:
+    """Call the function under tracemalloc.
+
+    :returns: Size of memory still allocated after the call and peak size
+        of allocated memory, in bytes
+    """
+
+    tracemalloc.start()
+
+    try:
+        function(*args)
+
+        return tracemalloc.get_traced_memory()
+
+    finally:
+        tracemalloc.stop()
+
+
+def create_context(project_path: Path) -> dict:
+    return {'project_path': project_path, 'config': {'tmp_dir': '__folianttmp__'}}
+
+
+def generate_project(working_dir: Path, files: int) -> float:
+    """Write the generated documents into the working directory.
+
+    :returns: Size of the project in MB
+    """
+
+    working_dir.mkdir(parents=True, exist_ok=True)
+    size = 0
+
+    for file_number in range(files):
+        markdown_content = generate_document(50, file_number)
+        size += len(markdown_content.encode())
+
+        with open(working_dir / f'{file_number}.md', 'w', encoding='utf8') as markdown_file:
+            markdown_file.write(markdown_content)
+
+    return size / 2**20
+
+
+def report_documents():
+    print('Single document:')
+    print(f'{"sections":>9} {"size, MB":>9} {"peak, MB":>9} {"MB per MB":>10}')
+
+    with TemporaryDirectory() as tmp_dir:
+        preprocessor = escapecode.Preprocessor(create_context(Path(tmp_dir)), getLogger('memory_peak'))
+
+        # Create the parser before measuring
+        preprocessor.escape('`warm up`\n')
+
+        for sections in (250, 500, 1000, 2000):
+            markdown_content = generate_document(sections)
+            size = len(markdown_content.encode()) / 2**20
+            peak = measure_peak(preprocessor.escape_document, markdown_content)[1] / 2**20
+
+            print(f'{sections:>9} {size:>9.2f} {peak:>9.2f} {peak / size:>10.1f}')
+
+    print()
+
+
+def report_project(files: int):
+    print(f'Project of {files} files:')
+    print(f'{"size, MB":>9} {"escape, MB":>11} {"unescape, MB":>13} {"MB per MB":>10}')
+
+    with TemporaryDirectory() as tmp_dir:
+        context = create_context(Path(tmp_dir))
+        escape_preprocessor = escapecode.Preprocessor(context, getLogger('memory_peak'))
+        unescape_preprocessor = unescapecode.Preprocessor(context, getLogger('memory_peak'))
+
+        escape_preprocessor.escape('`warm up`\n')
+
+        size = generate_project(escape_preprocessor.working_dir, files)
+        escape_peak = measure_peak(escape_preprocessor.apply)[1] / 2**20
+        unescape_peak = measure_peak(unescape_preprocessor.apply)[1] / 2**20
+
+        print(
+            f'{size:>9.2f} {escape_peak:>11.2f} {unescape_peak:>13.2f} ' +
+            f'{max(escape_peak, unescape_peak) / size:>10.1f}'
+        )
+
+    print()
+
+
+def report_daemon(files: int):
+    print(f'Daemon, project of {files} files:')
+    print(f'{"mode":>8} {"size, MB":>9} {"kept, MB":>9} {"MB per MB":>10}')
+
+    caching_escapecode = _create_preprocessor_classes()['escape']
+
+    for lean_memory in (False, True):
+        with TemporaryDirectory() as tmp_dir:
+            preprocessor = caching_escapecode(
+                create_context(Path(tmp_dir)), getLogger('memory_peak'), options={'lean_memory': lean_memory}
+            )
+
+            preprocessor.escape('`warm up`\n')
+
+            size = generate_project(preprocessor.working_dir, files)
+            kept = measure_peak(preprocessor.apply)[0] / 2**20
+            mode = 'lean' if lean_memory else 'default'
+
+            print(f'{mode:>8} {size:>9.2f} {kept:>9.2f} {kept / size:>10.1f}')
+
+    print()
+
+
+def main():
+    parser = ArgumentParser(description='Measure peak memory per MB of input.')
+    parser.add_argument('--files', type=int, default=50, help='Number of files in the generated project')
+    args = parser.parse_args()
+
+    report_documents()
+    report_project(args.files)
+    report_daemon(args.files)
+
+
+if __name__ == '__main__':
+    main()
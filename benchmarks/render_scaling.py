@@ -0,0 +1,103 @@
+"""
+Scaling benchmark for the EscapeCode renderer.
+
+Escapes generated documents with nested lists and block quotes
+and reports the processing time per KB of input. With rendering
+that does not copy nested content once per level, the time per KB
+stays roughly constant as the nesting depth and the document size grow.
+
+Usage::
+
+    $ python3 benchmarks/render_scaling.py [--repeat N]
+"""
+
+from argparse import ArgumentParser
+from logging import getLogger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from foliant.preprocessors.escapecode import Preprocessor
+
+
+def generate_document(depth: int, items: int) -> str:
+    """Generate a Markdown document with ``items`` top-level list items,
+    each containing a list nested ``depth`` levels deep, with block quotes
+    and inline code on every level.
+
+    :param depth: Nesting depth
+    :param items: Number of top-level list items
+
+    :returns: Markdown content
+    """
+
+    lines = []
+
+    for item in range(items):
+        for level in range(depth):
+            indent = '  ' * level
+            lines.append(f'{indent}- item {item}.{level} with `inline code` and some text')
+            lines.append(f'{indent}  > quoted text on level {level}')
+            lines.append(f'{indent}  > with `more code`')
+
+    return '\n'.join(lines) + '\n'
+
+
+def measure(preprocessor: Preprocessor, markdown_content: str, repeat: int) -> float:
+    """Escape the content several times.
+
+    :returns: The best time in seconds
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        start_time = perf_counter()
+        preprocessor.escape(markdown_content)
+        timings.append(perf_counter() - start_time)
+
+    return min(timings)
+
+
+def report(preprocessor: Preprocessor, title: str, cases: list, repeat: int):
+    print(title)
+    print(f'{"depth":>6} {"items":>6} {"size, KB":>10} {"time, ms":>10} {"ms per KB":>10}')
+
+    for depth, items in cases:
+        markdown_content = generate_document(depth, items)
+        size = len(markdown_content.encode()) / 1024
+        elapsed_time = measure(preprocessor, markdown_content, repeat)
+
+        print(f'{depth:>6} {items:>6} {size:>10.1f} {elapsed_time * 1000:>10.1f} {elapsed_time * 1000 / size:>10.3f}')
+
+    print()
+
+
+def main():
+    parser = ArgumentParser(description='Measure rendering time over nesting depth and document size.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs per case')
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp_dir:
+        preprocessor = Preprocessor(
+            {'project_path': Path(tmp_dir), 'config': {'tmp_dir': '__folianttmp__'}},
+            getLogger('render_scaling')
+        )
+
+        report(
+            preprocessor,
+            'Nesting depth, fixed size:',
+            [(depth, 240 // depth) for depth in (1, 2, 4, 8, 12, 16, 24)],
+            args.repeat
+        )
+
+        report(
+            preprocessor,
+            'Document size, fixed depth:',
+            [(8, items) for items in (5, 10, 20, 40, 80)],
+            args.repeat
+        )
+
+
+if __name__ == '__main__':
+    main()
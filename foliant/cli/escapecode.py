@@ -0,0 +1,303 @@
+'''CLI extension for Foliant that provides the ``escapecode`` command.
+Escapes or unescapes the Markdown files of a directory tree outside of a Foliant build,
+reports fragment statistics without writing anything, or only populates the cache directory.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import md5
+from logging import getLogger, DEBUG, WARNING
+from pathlib import Path
+from signal import signal, SIGTERM
+from typing import List, Tuple
+
+import yaml
+
+from cliar import set_arg_map, set_sharg_map, set_metavars, set_help
+
+from foliant.utils import output
+from foliant.cli.base import BaseCli
+from foliant.preprocessors import escapecode, unescapecode
+
+
+class RecordingPreprocessor(escapecode.Preprocessor):
+    '''EscapeCode preprocessor that records the hashes and sizes of saved fragments.
+    In the dry-run mode, fragments are not written into the cache directory.
+    '''
+
+    def __init__(self, *args, dry_run=False, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.dry_run = dry_run
+        self.fragments = []
+
+    def _save_raw_content(self, content_to_save: str) -> str:
+        if self.dry_run:
+            content_to_save_hash = f'{md5(content_to_save.encode()).hexdigest()}'
+
+        else:
+            content_to_save_hash = super()._save_raw_content(content_to_save)
+
+        self.fragments.append((content_to_save_hash, len(content_to_save.encode())))
+
+        return content_to_save_hash
+
+
+_worker_preprocessor = None
+
+
+def _init_worker(action: str, context: dict, options: dict, quiet: bool, debug: bool, dry_run: bool):
+    '''Create the preprocessor once per worker process.'''
+
+    global _worker_preprocessor
+
+    logger = getLogger('flt')
+    logger.setLevel(DEBUG if debug else WARNING)
+
+    if action == 'unescape':
+        _worker_preprocessor = unescapecode.Preprocessor(context, logger, quiet, debug, options)
+
+    else:
+        _worker_preprocessor = RecordingPreprocessor(
+            context, logger, quiet, debug, options, dry_run=dry_run
+        )
+
+
+def _process_file(markdown_file_path: Path, write: bool) -> Tuple[Path, List[Tuple[str, int]]]:
+    '''Escape or unescape a single file with the preprocessor of the current worker.
+
+    :param markdown_file_path: Path to the Markdown file
+    :param write: Write the processed content back into the file
+
+    :returns: Path to the file and the list of hashes and sizes of saved fragments
+    '''
+
+    preprocessor = _worker_preprocessor
+
+    with open(markdown_file_path, encoding='utf8') as markdown_file:
+        markdown_content = markdown_file.read()
+
+    with escapecode.profile_file(preprocessor, markdown_file_path, preprocessor._cache_dir_path, 'escapecode'):
+        if isinstance(preprocessor, RecordingPreprocessor):
+            preprocessor.fragments = []
+            processed_content = preprocessor.escape_document(markdown_content)
+            fragments = preprocessor.fragments
+
+        else:
+            processed_content = preprocessor.unescape(markdown_content)
+            fragments = []
+
+    if write and processed_content:
+        with open(markdown_file_path, 'w', encoding='utf8') as markdown_file:
+            markdown_file.write(processed_content)
+
+    return markdown_file_path, fragments
+
+
+class Cli(BaseCli):
+    @staticmethod
+    def _load_options(options_file: str) -> dict:
+        '''Load EscapeCode options from a YAML file, e.g. the value of ``escape_code.options``.'''
+
+        if not options_file:
+            return {}
+
+        with open(options_file, encoding='utf8') as options_file_obj:
+            options = yaml.safe_load(options_file_obj) or {}
+
+        if isinstance(options.get('cache_dir'), list):
+            options['cache_dir'] = [Path(layer) for layer in options['cache_dir']]
+
+        elif 'cache_dir' in options:
+            options['cache_dir'] = Path(options['cache_dir'])
+
+        return options
+
+    @staticmethod
+    def _print_stats(results: list, source_dir_path: Path, cache_layer_paths: List[Path]):
+        '''Print per-file fragment counts and sizes, and the projected cache size.
+        Fragments found in any cache layer are not counted as new.
+        '''
+
+        unique_fragments = {}
+
+        for markdown_file_path, fragments in sorted(results):
+            unique_fragments.update(fragments)
+            file_bytes = sum(size for _, size in fragments)
+
+            print(
+                f'{markdown_file_path.relative_to(source_dir_path)}: ' +
+                f'{len(fragments)} fragments ({len(set(fragments))} unique), {file_bytes} bytes'
+            )
+
+        cached_hashes = escapecode.index_cache_layers(cache_layer_paths)
+
+        new_fragments = {
+            fragment_hash: size
+            for fragment_hash, size in unique_fragments.items()
+            if fragment_hash not in cached_hashes
+        }
+
+        print('─' * 20)
+        print(f'Files: {len(results)}')
+        print(f'Fragments: {sum(len(fragments) for _, fragments in results)}')
+        print(f'Unique fragments: {len(unique_fragments)}, {sum(unique_fragments.values())} bytes')
+        print(
+            f'Projected cache size: {len(new_fragments)} new files, ' +
+            f'{sum(new_fragments.values())} bytes'
+        )
+
+    @set_arg_map(
+        {
+            'source_dir': 'path',
+            'options_file': 'options',
+            'logs_dir': 'logs'
+        }
+    )
+    @set_sharg_map({'prime_cache': None})
+    @set_metavars({'action': 'ACTION'})
+    @set_help(
+        {
+            'action': 'escape or unescape.',
+            'source_dir': 'Directory with Markdown files to process.',
+            'cache_dir': 'Cache directory, replaces all cache layers from the options file.',
+            'options_file': 'YAML file with EscapeCode options.',
+            'workers': 'Number of worker processes.',
+            'stats': 'Report fragment counts, sizes and projected cache size without writing anything.',
+            'prime_cache': 'Only populate the cache directory, leave the source files intact.',
+            'logs_dir': 'Path to the directory to store logs, defaults to current directory.',
+            'quiet': 'Hide all output except for the result.',
+            'debug': 'Log all events. If not set, only warnings and errors are logged.'
+        }
+    )
+    def escapecode(
+            self,
+            action,
+            source_dir=Path('.'),
+            cache_dir='',
+            options_file='',
+            workers=1,
+            stats=False,
+            prime_cache=False,
+            logs_dir='',
+            quiet=False,
+            debug=False
+        ):
+        '''Escape or unescape raw content in Markdown files with EscapeCode and UnescapeCode.'''
+
+        self.logger.setLevel(DEBUG if debug else WARNING)
+
+        if logs_dir:
+            super().__init__(logs_dir)
+
+        if action not in ('escape', 'unescape'):
+            self.logger.critical(f'Unknown action: {action}')
+            exit(f'Unknown action: {action}. Use escape or unescape.')
+
+        if action == 'unescape' and (stats or prime_cache):
+            self.logger.critical('Statistics and cache priming are available for escaping only')
+            exit('Statistics and cache priming are available for escaping only.')
+
+        options = self._load_options(options_file)
+
+        if cache_dir:
+            options['cache_dir'] = Path(cache_dir)
+
+        project_path = Path('.').resolve()
+        source_dir_path = Path(source_dir).resolve()
+
+        context = {
+            'project_path': project_path,
+            'config': {
+                'tmp_dir': source_dir_path
+            }
+        }
+
+        markdown_file_paths = sorted(source_dir_path.rglob('*.md'))
+        write = not (stats or prime_cache)
+        initargs = (action, context, options, quiet, debug, stats)
+
+        self.logger.info(
+            f'{action.capitalize()} {len(markdown_file_paths)} files in {source_dir_path}, ' +
+            f'workers: {workers}'
+        )
+
+        if workers > 1:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as executor:
+                results = list(
+                    executor.map(
+                        _process_file,
+                        markdown_file_paths,
+                        [write] * len(markdown_file_paths),
+                        chunksize=max(1, len(markdown_file_paths) // (workers * 4))
+                    )
+                )
+
+        else:
+            _init_worker(*initargs)
+            results = [_process_file(markdown_file_path, write) for markdown_file_path in markdown_file_paths]
+
+        if stats:
+            cache_layer_paths = escapecode.get_cache_layer_paths(
+                project_path, options.get('cache_dir', escapecode.Preprocessor.defaults['cache_dir'])
+            )
+
+            self._print_stats(results, source_dir_path, cache_layer_paths)
+
+        else:
+            output(f'Processed files: {len(results)}', quiet)
+
+        self.logger.info('Done')
+
+    @set_arg_map(
+        {
+            'socket_path': 'socket',
+            'logs_dir': 'logs'
+        }
+    )
+    @set_help(
+        {
+            'socket_path': 'Path to the Unix socket to listen on.',
+            'logs_dir': 'Path to the directory to store logs, defaults to current directory.',
+            'quiet': 'Hide all output.',
+            'debug': 'Log all events. If not set, only warnings and errors are logged.'
+        }
+    )
+    def escapecode_daemon(
+            self,
+            socket_path=Path('.escapecode.sock'),
+            logs_dir='',
+            quiet=False,
+            debug=False
+        ):
+        '''Run the daemon that applies EscapeCode and UnescapeCode on request over a Unix socket.'''
+
+        from foliant.preprocessors._escapecode_daemon import EscapeCodeDaemon, is_daemon_running
+
+        self.logger.setLevel(DEBUG if debug else WARNING)
+
+        if logs_dir:
+            super().__init__(logs_dir)
+
+        socket_path = Path(socket_path).resolve()
+
+        if socket_path.exists():
+            if is_daemon_running(socket_path):
+                exit(f'Another daemon is already listening on {socket_path}')
+
+            self.logger.debug(f'Removing the stale socket: {socket_path}')
+
+            socket_path.unlink()
+
+        signal(SIGTERM, lambda signum, frame: exit(0))
+
+        with EscapeCodeDaemon(socket_path, self.logger) as daemon:
+            output(f'Listening on {socket_path}', quiet)
+
+            try:
+                daemon.serve_forever()
+
+            except KeyboardInterrupt:
+                output('Stopped', quiet)
+
+            finally:
+                socket_path.unlink()
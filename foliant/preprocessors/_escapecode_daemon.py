@@ -0,0 +1,280 @@
+"""
+Daemon mode for the ``escapecode`` and ``unescapecode`` preprocessors.
+
+The daemon is a local Unix socket service that keeps preprocessors,
+their Marko parsers, an in-memory index of the saved fragments,
+and the results of escaping between requests. The preprocessors
+with the ``daemon`` option send their work to the daemon
+and fall back to processing the files locally if it is unavailable.
+
+Requests and responses are single lines of JSON.
+"""
+
+import json
+import socket
+
+from hashlib import md5
+from logging import Logger
+from pathlib import Path
+from socketserver import StreamRequestHandler, UnixStreamServer
+
+
+def request_daemon(preprocessor, action: str) -> bool:
+    """Ask the daemon to apply the preprocessor to its working directory.
+
+    :param preprocessor: Preprocessor instance with the ``daemon`` option
+    :param action: ``escape`` or ``unescape``
+
+    :returns: ``True`` if the daemon has processed the files,
+        ``False`` if they should be processed locally
+    """
+
+    socket_path = Path(preprocessor.options['daemon'])
+
+    if not socket_path.is_absolute():
+        socket_path = preprocessor.project_path / socket_path
+
+    options = {
+        key: value for key, value in preprocessor.options.items()
+        if key not in ('daemon', 'daemon_timeout')
+    }
+
+    request = {
+        'action': action,
+        'project_path': str(Path(preprocessor.project_path).resolve()),
+        'tmp_dir': str(preprocessor.config['tmp_dir']),
+        'options': options,
+        'quiet': preprocessor.quiet,
+        'debug': preprocessor.debug
+    }
+
+    preprocessor.logger.debug(f'Sending the request to the daemon: {socket_path}')
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            # A daemon that hangs must not block the build, a timeout raises ``OSError``
+            client.settimeout(preprocessor.options.get('daemon_timeout', 60))
+            client.connect(str(socket_path))
+            client.sendall(json.dumps(request, default=str).encode() + b'\n')
+
+            with client.makefile('rb') as response_file:
+                response = json.loads(response_file.readline() or b'{}')
+
+    except (OSError, ValueError) as exception:
+        preprocessor.logger.warning(f'Daemon is unavailable, processing files locally: {exception}')
+
+        return False
+
+    if response.get('status') != 'ok':
+        preprocessor.logger.warning(
+            f'Daemon failed, processing files locally: {response.get("message", "no response")}'
+        )
+
+        return False
+
+    preprocessor.logger.debug('Files processed by the daemon')
+
+    return True
+
+
+def is_daemon_running(socket_path: Path) -> bool:
+    """Check if a daemon accepts connections on the socket.
+
+    :param socket_path: Path to an existing socket file
+
+    :returns: ``False`` if the socket is left by a daemon that has exited
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+
+        except ConnectionRefusedError:
+            return False
+
+    return True
+
+
+class EscapedDocument:
+    """Result of escaping a file kept by the daemon between requests."""
+
+    __slots__ = 'source_hash', 'content', 'hashes'
+
+    def __init__(self, source_hash: str, content: str, hashes: frozenset):
+        self.source_hash = source_hash
+        self.content = content
+        self.hashes = hashes
+
+
+def _create_preprocessor_classes():
+    """Define the daemon-side preprocessor classes.
+    The preprocessors are imported here, so the client side
+    of this module does not load them.
+    """
+
+    from foliant.preprocessors import escapecode, unescapecode
+
+    class CachingEscapeCode(escapecode.Preprocessor):
+        """EscapeCode preprocessor that keeps the index of saved fragments
+        and, unless the ``lean_memory`` option is set, the result of escaping
+        each file between requests. Results are keyed by the file path and
+        replaced when the file changes, so they do not outlive the files.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+
+            self._known_hashes = set()
+            self._results = {}
+            self._cache_dir_mtime = None
+
+        def _cache_dir_state(self) -> int or None:
+            try:
+                return self._cache_dir_path.stat().st_mtime_ns
+
+            except FileNotFoundError:
+                return None
+
+        def _refresh_index(self) -> None:
+            """Rebuild the fragment index if the cache directory was changed by someone else.
+            Manifests and profiling data are kept in subdirectories, so writing and removing
+            them does not change the modification time of the cache directory.
+            """
+
+            cache_dir_mtime = self._cache_dir_state()
+
+            if cache_dir_mtime != self._cache_dir_mtime:
+                self.logger.debug('Cache directory changed, rebuilding the fragment index')
+
+                self._known_hashes = {
+                    fragment_file_path.stem for fragment_file_path in self._cache_dir_path.glob('*.md')
+                }
+
+        def _save_raw_content(self, content_to_save: str) -> str:
+            content_to_save_hash = f'{md5(content_to_save.encode()).hexdigest()}'
+
+            if content_to_save_hash not in self._known_hashes:
+                super()._save_raw_content(content_to_save)
+
+                self._known_hashes.add(content_to_save_hash)
+
+            return content_to_save_hash
+
+        def _escape_file_content(self, markdown_file_path: Path, markdown_content: str) -> str:
+            if self.options.get('lean_memory', False):
+                return super()._escape_file_content(markdown_file_path, markdown_content)
+
+            rel_path = markdown_file_path.relative_to(self.working_dir).as_posix()
+            source_hash = md5(markdown_content.encode()).hexdigest()
+            result = self._results.get(rel_path)
+
+            if result is not None and result.source_hash == source_hash and result.hashes <= self._known_hashes:
+                self.logger.debug('File not changed, using the previous result')
+
+                return result.content
+
+            processed_content = super()._escape_file_content(markdown_file_path, markdown_content)
+
+            self._results[rel_path] = EscapedDocument(
+                source_hash,
+                processed_content,
+                frozenset(escapecode.ESCAPED_HASH_PATTERN.findall(processed_content))
+            )
+
+            return processed_content
+
+        def apply(self):
+            self._refresh_index()
+
+            super().apply()
+
+            self._cache_dir_mtime = self._cache_dir_state()
+
+            self._results = {
+                rel_path: result for rel_path, result in self._results.items()
+                if (self.working_dir / rel_path).exists()
+            }
+
+    class CachingUnescapeCode(unescapecode.Preprocessor):
+        """UnescapeCode preprocessor that keeps the index of the cache layers
+        between requests. Fragments saved or removed since the index was built
+        are looked up in the layers on demand.
+        """
+
+        def _reset_fragment_index(self) -> None:
+            pass
+
+    return {
+        'escape': CachingEscapeCode,
+        'unescape': CachingUnescapeCode
+    }
+
+
+class EscapeCodeDaemon(UnixStreamServer):
+    """Unix socket server that applies the preprocessors on request.
+    Preprocessors are created once per action, project, temporary directory,
+    and options, and reused by the following requests.
+    """
+
+    def __init__(self, socket_path: Path, logger: Logger):
+        self.logger = logger.getChild('escapecode_daemon')
+        self.preprocessor_classes = _create_preprocessor_classes()
+        self.preprocessors = {}
+
+        super().__init__(str(socket_path), EscapeCodeRequestHandler)
+
+    def get_preprocessor(self, request: dict):
+        key = json.dumps(
+            [request['action'], request['project_path'], request['tmp_dir'], request['options']],
+            sort_keys=True
+        )
+
+        if key not in self.preprocessors:
+            self.logger.debug(f'Creating the preprocessor: {key}')
+
+            options = dict(request['options'])
+
+            if isinstance(options.get('cache_dir'), list):
+                options['cache_dir'] = [Path(layer) for layer in options['cache_dir']]
+
+            elif 'cache_dir' in options:
+                options['cache_dir'] = Path(options['cache_dir'])
+
+            context = {
+                'project_path': Path(request['project_path']),
+                'config': {
+                    'tmp_dir': request['tmp_dir']
+                }
+            }
+
+            self.preprocessors[key] = self.preprocessor_classes[request['action']](
+                context,
+                self.logger,
+                request.get('quiet', False),
+                request.get('debug', False),
+                options
+            )
+
+        return self.preprocessors[key]
+
+
+class EscapeCodeRequestHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+
+            if request.get('action') not in self.server.preprocessor_classes:
+                raise ValueError(f'Unknown action: {request.get("action")}')
+
+            self.server.logger.info(f'Request: {request["action"]} {request["project_path"]}')
+
+            self.server.get_preprocessor(request).apply()
+
+            response = {'status': 'ok'}
+
+        except Exception as exception:
+            self.server.logger.exception('Request failed')
+
+            response = {'status': 'error', 'message': str(exception)}
+
+        self.wfile.write(json.dumps(response).encode() + b'\n')
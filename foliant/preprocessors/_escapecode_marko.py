@@ -0,0 +1,599 @@
+"""
+Marko-based parser and renderer used by the ``escapecode`` preprocessor.
+This module is imported lazily on the first ``escape()`` call,
+so importing ``escapecode`` alone does not load Marko.
+"""
+
+import re
+from threading import Lock, local
+
+import marko.block as block
+
+from marko import Markdown, inline, inline_parser, patterns
+from marko.helpers import Source, find_next, normalize_label, partition_by_spaces
+from marko.md_renderer import MarkdownRenderer
+
+
+class _ThreadLocalProxy:
+    """Replacement for a Marko module global, such as ``block.parser``.
+    Attribute access is forwarded to the object set for the current thread,
+    or to the value that the global had before, so other Marko users
+    are not affected.
+    """
+
+    def __init__(self):
+        self._local = local()
+        self.fallback = None
+
+    def set_target(self, target) -> None:
+        self._local.target = target
+
+    def _get_target(self):
+        target = getattr(self._local, 'target', None)
+
+        return self.fallback if target is None else target
+
+    @property
+    def __class__(self):
+        # Marko checks the parser with ``isinstance()``
+        return type(self._get_target())
+
+    def __getattr__(self, name: str):
+        return getattr(self._get_target(), name)
+
+
+_parser_proxy = _ThreadLocalProxy()
+_root_node_proxy = _ThreadLocalProxy()
+
+_proxied_globals = (
+    (block, 'parser', _parser_proxy),
+    (inline, 'parser', _parser_proxy),
+    (inline, '_root_node', _root_node_proxy)
+)
+
+# Guards the module globals while a parser is created or the proxies are installed
+_globals_lock = Lock()
+
+
+def _install_proxies() -> None:
+    """Point the Marko module globals at the thread-local proxies.
+    Creating a plain Marko parser or document replaces them,
+    so this is checked before each parse.
+    """
+
+    if all(getattr(module, name) is proxy for module, name, proxy in _proxied_globals):
+        return
+
+    with _globals_lock:
+        for module, name, proxy in _proxied_globals:
+            value = getattr(module, name)
+
+            if value is not proxy:
+                proxy.fallback = value
+                setattr(module, name, proxy)
+
+
+class FoliantMarkdown(Markdown):
+    def _setup_extensions(self) -> None:
+        """Create the parser and the renderer.
+        Creating the parser also sets the module-level references to it,
+        so restore the previous ones, and the overridden elements
+        do not leak into other Marko users.
+        """
+        if self._setup_done:
+            return
+        with _globals_lock:
+            block_parser, inline_parser_ = block.parser, inline.parser
+            try:
+                super()._setup_extensions()
+            finally:
+                block.parser, inline.parser = block_parser, inline_parser_
+
+    def parse(self, text: str) -> block.Document:
+        """Call ``self.parser.parse(text)``.
+        Marko keeps module-level references to the active parser
+        and the document being parsed, so they are pointed at proxies
+        that forward to this instance's parser and document in the current
+        thread only. Several documents can be parsed in parallel.
+        """
+        self._setup_extensions()
+        _install_proxies()
+        _parser_proxy.set_target(self.parser)
+        try:
+            return self.parser.parse(text)
+        finally:
+            _parser_proxy.set_target(None)
+            _root_node_proxy.set_target(None)
+
+    def render(self, parsed: block.Document, foliant_obj) -> str:
+        """Call ``self.renderer.render(text)``.
+        Override this to handle the parsed result.
+        """
+        self.renderer.foliant_obj = foliant_obj
+        self.renderer.root_node = parsed
+        with self.renderer as r:
+            return r.render(parsed)
+
+
+# The elements below store the parsing state in the source being parsed
+# rather than in the class or in the module, unlike their Marko counterparts,
+# so several documents can be parsed independently.
+
+class Document(block.Document):
+    """Document that is set as the root node for the current thread only."""
+
+    override = True
+
+    def __init__(self, text: str) -> None:
+        self.link_ref_defs = {}
+        source = Source(text)
+        _root_node_proxy.set_target(self)
+        with source.under_state(self):
+            self.children = block.parser.parse(source)
+        self.parse_inline()
+
+
+class FencedCode(block.FencedCode):
+    override = True
+
+    @classmethod
+    def match(cls, source: Source) -> re.Match or None:
+        m = source.expect_re(cls.pattern)
+        if not m:
+            return None
+        prefix, leading, info = m.groups()
+        if leading[0] == "`" and "`" in info:
+            return None
+        lang, _, extra = partition_by_spaces(info)
+        source.fenced_code_state = prefix, leading, lang, extra
+        return m
+
+    @classmethod
+    def parse(cls, source: Source) -> tuple:
+        prefix, leading, lang, extra = source.fenced_code_state
+        source.next_line()
+        source.consume()
+        lines = []
+        while not source.exhausted:
+            line = source.next_line()
+            if line is None:
+                break
+            source.consume()
+            m = re.match(r" {,3}(~+|`+)[^\n\S]*$", line, flags=re.M)
+            if m and leading in m.group(1):
+                break
+
+            prefix_len = source.match_prefix(prefix, line)
+            if prefix_len >= 0:
+                line = line[prefix_len:]
+            else:
+                line = line.lstrip()
+            lines.append(line)
+        return lang, extra, "".join(lines)
+
+
+class HTMLBlock(block.HTMLBlock):
+    """HTML block that remembers its type, e.g. ``2`` for comments."""
+
+    override = True
+
+    def __init__(self, data: tuple) -> None:
+        self.children, self.id = data
+
+    @staticmethod
+    def _matched(source: Source, end_cond, html_type: int) -> int:
+        source.html_block_state = end_cond, html_type
+        return html_type
+
+    @classmethod
+    def match(cls, source: Source) -> int or bool:
+        if source.expect_re(r"(?i) {,3}<(script|pre|style|textarea)[>\s]"):
+            assert source.match
+            return cls._matched(source, re.compile(rf"(?i)</{source.match.group(1)}>"), 1)
+        if source.expect_re(r" {,3}<!--"):
+            return cls._matched(source, re.compile(r"-->"), 2)
+        if source.expect_re(r" {,3}<\?"):
+            return cls._matched(source, re.compile(r"\?>"), 3)
+        if source.expect_re(r" {,3}<!"):
+            return cls._matched(source, re.compile(r">"), 4)
+        if source.expect_re(r" {,3}<!\[CDATA\["):
+            return cls._matched(source, re.compile(r"]]>"), 5)
+        block_tag = r"(?:{})".format("|".join(patterns.tags))
+        if source.expect_re(r"(?im) {,3}</?%s(?: +|/?>|$)" % block_tag):
+            return cls._matched(source, None, 6)
+        if source.expect_re(
+            r"(?m) {,3}(<%(tag)s(?:%(attr)s)*[^\n\S]*/?>|</%(tag)s[^\n\S]*>)[^\n\S]*$"
+            % {"tag": patterns.tag_name, "attr": patterns.attribute_no_lf}
+        ):
+            return cls._matched(source, None, 7)
+
+        return False
+
+    @classmethod
+    def parse(cls, source: Source) -> tuple:
+        end_cond, html_type = source.html_block_state
+        lines = []
+        while not source.exhausted:
+            line = source.next_line()
+            if line is None:
+                break
+            lines.append(line)
+            if end_cond is not None:
+                if end_cond.search(line):
+                    source.consume()
+                    break
+            elif line.strip() == "":
+                lines.pop()
+                break
+            source.consume()
+        return "".join(lines), html_type
+
+
+class List(block.List):
+    override = True
+
+    def __init__(self, parse_info: tuple) -> None:
+        self.bullet, self.ordered, self.start = parse_info
+        self.tight = True
+
+    @classmethod
+    def match(cls, source: Source) -> bool:
+        m = source.expect_re(cls.pattern)
+        if not m:
+            return False
+        bullet, ordered, start = m.group(1), False, 1
+        if bullet[:-1].isdigit():
+            ordered = True
+            start = int(bullet[:-1])
+        source.list_state = bullet, ordered, start
+        return True
+
+    @classmethod
+    def parse(cls, source: Source) -> 'List':
+        state = cls(source.list_state)
+        list_item = block.parser.block_elements["ListItem"]
+        children = []
+        tight = True
+        has_blank_line = False
+        with source.under_state(state):
+            while not source.exhausted:
+                if list_item.match(source):
+                    el = list_item.parse(source)
+                    if not isinstance(el, block.BlockElement):
+                        el = list_item(el)
+                    children.append(el)
+                    source.anchor()
+                    if has_blank_line:
+                        tight = False
+                elif block.BlankLine.match(source):
+                    block.BlankLine.parse(source)
+                    has_blank_line = True
+                else:
+                    source.reset()
+                    break
+        tight = tight and not any(
+            isinstance(e, block.BlankLine) for item in children for e in item.children
+        )
+        if tight:
+            for item in children:
+                item._tight = tight
+                for child in item.children:
+                    if isinstance(child, block.Paragraph):
+                        child._tight = tight
+        state.children = children
+        state.tight = tight
+        return state
+
+
+class ListItem(block.ListItem):
+    override = True
+
+    def __init__(self, parse_info: tuple) -> None:
+        indent, bullet, mid = parse_info
+        self._prefix = " " * indent + re.escape(bullet) + " " * mid
+        self._second_prefix = " " * (len(bullet) + indent + (mid or 1))
+
+    @classmethod
+    def match(cls, source: Source) -> bool:
+        if block.parser.block_elements["ThematicBreak"].match(source):
+            return False
+        if not source.expect_re(cls.pattern):
+            return False
+        next_line = source.next_line(False).expandtabs(4)
+        prefix_pos = 0
+        m = re.match(source.prefix, next_line)
+        if m is not None:
+            prefix_pos = m.end()
+        indent, bullet, mid, _ = cls.parse_leading(next_line.rstrip(), prefix_pos)
+        parent = source.state
+        if (
+            parent.ordered
+            and not bullet[:-1].isdigit()
+            or bullet[-1] != parent.bullet[-1]
+        ):
+            return False
+        if not parent.ordered and bullet != parent.bullet:
+            return False
+        source.list_item_state = indent, bullet, mid
+        return True
+
+    @classmethod
+    def parse(cls, source: Source) -> 'ListItem':
+        state = cls(source.list_item_state)
+        state.children = []
+        with source.under_state(state):
+            if not source.next_line().strip():
+                source.consume()
+                if not source.next_line() or not source.next_line().strip():
+                    return state
+            state.children = block.parser.parse(source)
+        if isinstance(state.children[-1], block.BlankLine):
+            # Remove the last blank line from list item
+            blankline = state.children.pop()
+            if state.children:
+                source.pos = blankline._anchor
+        return state
+
+
+class LinkRefDef(block.LinkRefDef):
+    override = True
+
+    @classmethod
+    def match(cls, source: Source) -> bool:
+        m = source.expect_re(cls.pattern)
+        if not m:
+            return False
+        text = source._buffer
+        link_label = inline_parser._parse_link_label(text, m.start(1))
+        if not link_label:  # no ending bracket
+            return False
+        if link_label.end >= len(text) or text[link_label.end] != ":":
+            # no colon after the ending bracket
+            return False
+        i = inline_parser._parse_link_separator(text, link_label.end + 1)
+        try:
+            link_dest, link_title = inline_parser._parse_link_dest_title(text, i)
+        except inline_parser.ParseError:
+            return False
+        i = max(link_dest.end, link_title.end)
+        end = find_next(text, "\n", i)
+        if end >= 0:
+            end += 1
+        else:
+            end = i
+        if text[i:end].strip():
+            if link_title.text and "\n" in text[link_dest.end:link_title.start]:
+                link_title = inline_parser._EMPTY_GROUP
+                end = find_next(text, "\n", link_dest.end) + 1
+            else:
+                # There is content after the link title
+                return False
+        source.link_ref_def_state = link_label, link_dest, link_title, end
+        return True
+
+    @classmethod
+    def parse(cls, source: Source) -> 'LinkRefDef':
+        label, dest, title, pos = source.link_ref_def_state
+        normalized_label = normalize_label(label.text[1:-1])
+        if normalized_label not in source.root.link_ref_defs:
+            source.root.link_ref_defs[normalized_label] = (dest.text, title.text)
+        source.pos = pos
+        return cls()
+
+
+class EscapeCodeMarkdownRenderer(MarkdownRenderer):
+    # exclude admonitions syntax:
+    pre_blocks_pattern = re.compile(r'(\={3}|\!{3}|\?{3}|\?{3}\+)\s((\w+)(?: +\"(.*)\")|\"(.*)\")')
+
+    def __init__(self):
+        super().__init__()
+        self._prefix = None
+        self._pieces = None
+
+    def __enter__(self) -> 'EscapeCodeMarkdownRenderer':
+        # Unlike the base renderer, do not replace ``html._charref`` globally:
+        # Markdown rendering does not unescape character references.
+        self._prefix = ""
+        self._second_prefix = ""
+        return self
+
+    def __exit__(self, *args) -> None:
+        # Release the document and the preprocessor, so the renderer
+        # kept by the thread does not hold the last parsed tree in memory.
+        self.root_node = None
+        self.foliant_obj = None
+
+    @staticmethod
+    def _check_options(raw_type: str, actions) -> bool:
+        if actions:
+            for action in actions:
+                if type(action) == dict:
+                    for escape_action in action['escape']:
+                        if escape_action == raw_type:
+                            return True
+        return False
+
+    def render_setext_heading(self, element: block.SetextHeading) -> str:
+        result = self._prefix + self.render_children(element)
+        self._prefix = self._second_prefix
+        return result
+
+    def _escape_run(self, lines: list, run: list, raw_type: str) -> None:
+        """Replace the run of pre block lines with a single escaped fragment.
+        The lines that follow the first one in the run are saved with their
+        prefixes and indents, so unescaping gives the same result as escaping
+        line by line. These lines are replaced with ``None`` and must be dropped
+        by the caller. Blank lines may be part of the run only if the prefix
+        is empty, since normalization strips the trailing whitespace
+        of the prefixes, such as ``> ``, in the saved fragment.
+
+        :param lines: Rendered lines of the pre block
+        :param run: Indexes of the lines to escape; cleared after the call
+        :param raw_type
+        """
+        if not run:
+            return
+        first, last = run[0], run[-1]
+        first_line = lines[first].lstrip(" ")
+        indent = lines[first][:len(lines[first]) - len(first_line)]
+        fragment_lines = [first_line]
+        for line in lines[first + 1:last + 1]:
+            fragment_lines.append(self._second_prefix + line if line else "")
+        lines[first] = indent + self.foliant_obj.escape_for_raw_type("\n".join(fragment_lines), raw_type)
+        for i in range(first + 1, last + 1):
+            lines[i] = None
+        run.clear()
+
+    def render_code_block(self, element: block.CodeBlock) -> str:
+        foliant_obj = self.foliant_obj
+        indent = " " * 4; raw_type = 'pre_blocks'
+        exclude = False
+        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
+        lines = self.render_children(element).splitlines()
+        pattern = foliant_obj.options.get('pattern_override', {}).get(raw_type, '')
+        if run_escapecode:
+            block_granularity = foliant_obj.options.get('granularity', {}).get(raw_type, 'line') == 'block'
+            run = []
+            for i, line in enumerate(lines):
+                indent = " " * 4
+                if line.startswith(" "):
+                    indent = " " * (4 + len(re.search(r'^ +', line).group(0)))
+                if pattern: exclude = re.compile(pattern).search(line)
+                if exclude or re.search(r'\s<escaped*></escaped>', line) or self.pre_blocks_pattern.search(line):
+                    self._escape_run(lines, run, raw_type)
+                    lines[i] = indent + line.strip()
+                elif line.strip() == "":
+                    if self._second_prefix:
+                        self._escape_run(lines, run, raw_type)
+                    lines[i] = line.strip()
+                elif block_granularity:
+                    lines[i] = indent + line.strip()
+                    run.append(i)
+                else:
+                    lines[i] = indent + foliant_obj.escape_for_raw_type(line.strip(), raw_type)
+            self._escape_run(lines, run, raw_type)
+            lines = [line for line in lines if line is not None]
+            indent = ''
+        lines = [self._prefix + indent + lines[0]] + [
+            self._second_prefix + indent + line for line in lines[1:]
+        ]
+        self._prefix = self._second_prefix
+        return "\n".join(lines) + "\n"
+
+    def render_fenced_code(self, element: block.FencedCode) -> str:
+        foliant_obj = self.foliant_obj
+        raw_type = 'fence_blocks'
+        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
+        extra = f" {element.extra}" if element.extra else ""
+        first_line = f"```{element.lang}{extra}"
+        if run_escapecode:
+            first_line = foliant_obj.escape_for_raw_type(first_line, raw_type)
+        lines = [first_line]
+        for line in self.render_children(element).splitlines():
+            if line.strip() != "":
+                lines.append(self._second_prefix + line)
+            else:
+                lines.append(line)
+        last_line = self._second_prefix + "```"
+        lines.append(last_line)
+        code_block = "\n".join(lines)
+        if run_escapecode:
+            if not re.search(r'<escaped*></escaped>', code_block):
+                code_block = foliant_obj.escape_for_raw_type(code_block, raw_type)
+        self._prefix = self._second_prefix
+        return self._prefix + code_block + "\n"
+
+    def render_code_span(self, element: inline.CodeSpan) -> str:
+        text = element.children
+        foliant_obj = self.foliant_obj
+        raw_type = 'inline_code'
+        exclude = False
+        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
+        pattern = foliant_obj.options.get('pattern_override', {}).get(raw_type, '')
+        if run_escapecode:
+            if pattern: exclude = re.compile(pattern).search(text)
+            if exclude or re.search(r'<escaped*></escaped>', text):
+                text = text
+            else:
+                text = foliant_obj.escape_for_raw_type(text, raw_type)
+        if text and text[0] == "`" or text[-1] == "`":
+            return f"`` {text} ``"
+        return f"`{text}`"
+
+    def render_thematic_break(self, element: block.ThematicBreak) -> str:
+        result = self._prefix + "---\n"
+        self._prefix = self._second_prefix
+        return result
+
+    def _render_blocks(self, element: block.BlockElement) -> None:
+        """Render the block children of a container element into ``self._pieces``.
+        Containers append their output themselves and return an empty string,
+        so nested content is not copied once per nesting level.
+        """
+        for child in element.children:
+            piece = self.render(child)
+            if piece:
+                self._pieces.append(piece)
+
+    def render_document(self, element: block.Document) -> str:
+        self._pieces = []
+        self._render_blocks(element)
+        pieces, self._pieces = self._pieces, None
+        return "".join(pieces)
+
+    def render_list(self, element: block.List) -> str:
+        sep = "" if element.tight else f"{self._second_prefix}\n"
+        for index, child in enumerate(element.children):
+            if index and sep:
+                self._pieces.append(sep)
+            if element.ordered:
+                num = element.start + index
+                prefix, second_prefix = f"{num}. ", " " * (len(str(num)) + 2)
+            else:
+                prefix, second_prefix = f"{element.bullet} ", "  "
+            with self.container(prefix, second_prefix):
+                self.render(child)
+        self._prefix = self._second_prefix
+        return ""
+
+    def render_list_item(self, element: block.ListItem) -> str:
+        self._render_blocks(element)
+        return ""
+
+    def render_quote(self, element: block.Quote) -> str:
+        with self.container("> ", "> "):
+            self._render_blocks(element)
+        self._prefix = self._second_prefix
+        self._pieces.append("\n")
+        return ""
+
+    def render_html_block(self, element: block.HTMLBlock) -> str:
+        children = element.children
+        raw_type = 'comments'
+        foliant_obj = self.foliant_obj
+        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
+        exclude = False
+        pattern = foliant_obj.options.get('pattern_override', {}).get(raw_type, '')
+        if element.id == 2 and run_escapecode:
+            if pattern: exclude = re.compile(pattern).search(children)
+            if exclude or re.search(r'<escaped*></escaped>', children):
+                children = children
+            else:
+                children = foliant_obj.escape_for_raw_type(children, raw_type)
+        result = self._prefix + children + "\n"
+        self._prefix = self._second_prefix
+        return result
+
+
+class EscapeCodeExtension:
+    elements = [Document, FencedCode, HTMLBlock, List, ListItem, LinkRefDef]
+
+
+def create_markdown() -> FoliantMarkdown:
+    """Create the Markdown object with the parser and the renderer
+    overridden for the ``escapecode`` preprocessor only.
+
+    :returns: New ``FoliantMarkdown`` instance
+    """
+
+    return FoliantMarkdown(renderer=EscapeCodeMarkdownRenderer, extensions=[EscapeCodeExtension()])
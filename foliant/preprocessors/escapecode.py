@@ -5,17 +5,171 @@ that should not be processed by any preprocessors.
 """
 
 import re
+import os
+import json
 from pathlib import Path
+from typing import Dict, List
 from hashlib import md5
+from time import perf_counter
+from threading import local
+from contextlib import contextmanager
 
 from foliant.preprocessors.base import BasePreprocessor
 
-import marko
-import marko.block as block
+MANIFESTS_DIR_NAME = 'manifests'
+ESCAPED_HASH_PATTERN = re.compile(r'<escaped hash="(?P<hash>[0-9a-f]{32})"></escaped>')
+FRONTMATTER_CLOSING_PATTERN = re.compile(r'\n[-+]{3}')
 
-from marko import Markdown, inline, patterns
-from marko.helpers import Source
-from marko.md_renderer import MarkdownRenderer
+
+
+@contextmanager
+def profile_file(preprocessor: BasePreprocessor, markdown_file_path: Path, cache_dir_path: Path, profile_name: str):
+    """Measure the processing time of a single file if the ``profile`` option is set.
+    Log the files that take longer than ``profile.threshold`` seconds and,
+    if ``profile.dump`` is enabled, save cProfile statistics for them into
+    the ``profiles/<profile_name>`` subdirectory of the cache directory.
+
+    :param preprocessor: Preprocessor instance that processes the file
+    :param markdown_file_path: Path to the processed file
+    :param cache_dir_path: Path to the cache directory
+    :param profile_name: Name of the subdirectory for the statistics,
+        e.g. ``escapecode``
+    """
+
+    profile_options = preprocessor.options.get('profile')
+
+    if not profile_options:
+        yield
+        return
+
+    if type(profile_options) is not dict:
+        profile_options = {}
+
+    threshold = profile_options.get('threshold', 1.0)
+    profiler = None
+
+    if profile_options.get('dump', False):
+        from cProfile import Profile
+
+        profiler = Profile()
+        profiler.enable()
+
+    start_time = perf_counter()
+
+    try:
+        yield
+
+    finally:
+        elapsed_time = perf_counter() - start_time
+
+        if profiler:
+            profiler.disable()
+
+        if elapsed_time >= threshold:
+            rel_path = markdown_file_path.relative_to(preprocessor.working_dir)
+
+            preprocessor.logger.warning(f'Slow file: {rel_path}, processed in {elapsed_time:.3f} s')
+
+            if profiler:
+                dump_file_path = (
+                    cache_dir_path / 'profiles' / profile_name /
+                    f'{rel_path.as_posix()}.pstats'
+                )
+
+                dump_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+                profiler.dump_stats(str(dump_file_path))
+
+                preprocessor.logger.warning(f'Profiling data saved into the file: {dump_file_path}')
+
+
+def map_files(preprocessor: BasePreprocessor, function, markdown_file_paths: list) -> list:
+    """Apply the function to each file. If the ``threads`` option is greater than 1,
+    process the files in a thread pool of this size.
+
+    :param preprocessor: Preprocessor instance that processes the files
+    :param function: Function that takes the path to a file
+    :param markdown_file_paths: Paths to the files
+
+    :returns: Results of the function in the order of the files
+    """
+
+    threads = preprocessor.options.get('threads', 1)
+    profile_options = preprocessor.options.get('profile')
+
+    if threads > 1 and type(profile_options) is dict and profile_options.get('dump', False):
+        preprocessor.logger.warning('Profiling data dumps require sequential processing, threads are not used')
+
+        threads = 1
+
+    if threads > 1:
+        # Imported here, so importing this module stays cheap
+        from concurrent.futures import ThreadPoolExecutor
+
+        preprocessor.logger.debug(f'Processing files in {threads} threads')
+
+        with ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(function, markdown_file_paths))
+
+    return [function(markdown_file_path) for markdown_file_path in markdown_file_paths]
+
+
+def get_manifest_path(cache_dir_path: Path, working_dir: Path) -> Path:
+    """Get the path to the manifest of the build that uses the working directory.
+    Builds with different working directories may share the cache directory,
+    so each of them gets its own manifest in the ``manifests`` subdirectory.
+
+    :param cache_dir_path: Path to the cache directory
+    :param working_dir: Path to the working directory of the build
+
+    :returns: Path to the manifest file
+    """
+
+    working_dir_hash = md5(str(Path(working_dir).resolve()).encode()).hexdigest()
+
+    return cache_dir_path / MANIFESTS_DIR_NAME / f'{working_dir_hash}.json'
+
+
+def get_cache_layer_paths(project_path: Path, cache_dir: Path or str or list) -> List[Path]:
+    """Resolve the ``cache_dir`` option into the list of cache layers.
+    The option is either a single directory or an ordered list of directories.
+    The first one is the writable top layer; the others are read-only
+    seed caches, e.g. a cache shared between builds or checked out from CI.
+
+    :param project_path: Path to the project
+    :param cache_dir: Value of the ``cache_dir`` option
+
+    :returns: Resolved paths to the cache layers, top layer first
+    """
+
+    if not isinstance(cache_dir, (list, tuple)):
+        cache_dir = [cache_dir]
+
+    return [(project_path / Path(layer)).resolve() for layer in cache_dir]
+
+
+def index_cache_layers(cache_layer_paths: List[Path]) -> Dict[str, Path]:
+    """List the fragments saved in the cache layers. Each layer is scanned once,
+    so looking up a fragment does not touch the file system.
+
+    :param cache_layer_paths: Paths to the cache layers, top layer first
+
+    :returns: Mapping from the hashes of the fragments to the layers
+        that contain them; upper layers take precedence
+    """
+
+    index = {}
+
+    for cache_layer_path in reversed(cache_layer_paths):
+        if not cache_layer_path.is_dir():
+            continue
+
+        with os.scandir(cache_layer_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.md'):
+                    index[entry.name[:-3]] = cache_layer_path
+
+    return index
 
 
 class Preprocessor(BasePreprocessor):
@@ -36,10 +190,10 @@ class Preprocessor(BasePreprocessor):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.content = None
-        self.pre_blocks_pattern = None
-        self._cache_dir_path = (self.project_path / self.options['cache_dir']).resolve()
-        self.frontmatter_pattern = re.compile(r'^((-|\+){3})\n([\s\S]+?)\n((-|\+){3})([\s\S]*)')
+        self._local = local()
+        self._cache_layer_paths = get_cache_layer_paths(self.project_path, self.options['cache_dir'])
+        self._cache_dir_path = self._cache_layer_paths[0]
+        self._seed_hashes = None
 
         self.logger = self.logger.getChild('escapecode')
 
@@ -70,6 +224,18 @@ class Preprocessor(BasePreprocessor):
 
         return markdown_content
 
+    def _get_seed_hashes(self) -> frozenset:
+        """Get the hashes of the fragments saved in the read-only cache layers.
+        These layers are not changed by the build, so they are indexed once.
+
+        :returns: Hashes of the fragments in all layers except the top one
+        """
+
+        if self._seed_hashes is None:
+            self._seed_hashes = frozenset(index_cache_layers(self._cache_layer_paths[1:]))
+
+        return self._seed_hashes
+
     def _save_raw_content(self, content_to_save: str) -> str:
         """Calculate MD5 hash of raw content.
         Save the content into the file
@@ -83,6 +249,11 @@ class Preprocessor(BasePreprocessor):
 
         self.logger.debug(f'Hash of raw content part to save: {content_to_save_hash}')
 
+        if content_to_save_hash in self._get_seed_hashes():
+            self.logger.debug('Content part found in a seed cache layer, skipping')
+
+            return content_to_save_hash
+
         content_to_save_file_path = (self._cache_dir_path / f'{content_to_save_hash}.md').resolve()
 
         self.logger.debug(f'File to save: {content_to_save_file_path}')
@@ -173,6 +344,23 @@ class Preprocessor(BasePreprocessor):
 
         return tag_pattern.sub(_sub, markdown_content)
 
+    def _get_markdown(self):
+        """Create the Marko-based Markdown object on the first call in each thread.
+        Marko is imported here rather than at module level,
+        so importing this module stays cheap.
+
+        :returns: Markdown object used by this preprocessor instance in the current thread
+        """
+
+        markdown = getattr(self._local, 'markdown', None)
+
+        if markdown is None:
+            from foliant.preprocessors._escapecode_marko import create_markdown
+
+            markdown = self._local.markdown = create_markdown()
+
+        return markdown
+
     def escape(self, markdown_content: str) -> str:
         """Preparing to use parsing and rendering with Marko.
 
@@ -181,14 +369,9 @@ class Preprocessor(BasePreprocessor):
         :returns: Markdown content with replaced raw parts
         """
 
-        # exclude admonitions syntax:
-        self.pre_blocks_pattern = r'(\={3}|\!{3}|\?{3}|\?{3}\+)\s((\w+)(?: +\"(.*)\")|\"(.*)\")'
-
-        md = marko.Markdown(renderer=EscapeCodeMarkdownRenderer)
+        md = self._get_markdown()
 
-        self.content = md.parse(markdown_content)
-
-        markdown_content = md.render(self)
+        markdown_content = md.render(md.parse(markdown_content), self)
 
         if self.options.get('actions'):
             for action in self.options.get('actions', []):
@@ -243,227 +426,144 @@ class Preprocessor(BasePreprocessor):
 
         return markdown_content
 
+    @staticmethod
+    def _split_frontmatter(markdown_content: str) -> tuple or None:
+        """Split the frontmatter from the rest of the content in a single scan.
+        The frontmatter starts with ``---`` or ``+++`` on the first line
+        and ends with the first line that starts with ``---`` or ``+++``.
+
+        :param markdown_content: Content of the Markdown file
+
+        :returns: Tuple of the delimiter, the frontmatter and the content that
+            follows the closing delimiter, or ``None`` if there is no closed frontmatter
+        """
+
+        if markdown_content[:3] not in ('---', '+++') or markdown_content[3:4] != '\n':
+            return None
+
+        closing_match = FRONTMATTER_CLOSING_PATTERN.search(markdown_content, 5)
+
+        if not closing_match:
+            return None
+
+        closing_position = closing_match.start()
+
+        return (
+            markdown_content[:3],
+            markdown_content[4:closing_position],
+            markdown_content[closing_position + 4:]
+        )
+
+    def escape_document(self, markdown_content: str) -> str:
+        """Escape the content of a whole Markdown file.
+        If the file starts with the frontmatter, escape the frontmatter
+        separately when required, and the rest of the content as usual.
+
+        :param markdown_content: Content of the Markdown file
+
+        :returns: Markdown content with replaced raw parts
+        """
+
+        split_content = self._split_frontmatter(markdown_content)
+
+        if split_content is None:
+            return self.escape(markdown_content)
+
+        format, frontmatter, content = split_content
+
+        for action in self.options.get('actions', []):
+            if type(action) == dict:
+                for escape_action in action['escape']:
+                    if escape_action == 'frontmatter':
+                        frontmatter = self.escape_for_raw_type(frontmatter, 'fence_blocks')
+
+        return ''.join((format, '\n', frontmatter, '\n', format, '\n', self.escape(content)))
+
+    def _write_manifest(self, manifest: dict) -> None:
+        """Save the hashes of the ``<escaped>`` tags emitted into each file,
+        so the ``unescapecode`` preprocessor can skip the files without tags,
+        preload the fragments, and detect dropped tags.
+
+        :param manifest: Mapping from file paths relative to the working directory
+            to the lists of hashes
+        """
+
+        manifest_file_path = get_manifest_path(self._cache_dir_path, self.working_dir)
+
+        self.logger.debug(f'Writing the manifest: {manifest_file_path}')
+
+        manifest_file_path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(manifest_file_path, 'w', encoding='utf8') as manifest_file:
+            json.dump(manifest, manifest_file, ensure_ascii=False, indent=4)
+
+    def _escape_file_content(self, markdown_file_path: Path, markdown_content: str) -> str:
+        """Escape the content of the Markdown file.
+
+        :param markdown_file_path: Path to the Markdown file
+        :param markdown_content: Content of the Markdown file
+
+        :returns: Markdown content with replaced raw parts
+        """
+
+        with profile_file(self, markdown_file_path, self._cache_dir_path, 'escapecode'):
+            return self.escape_document(markdown_content)
+
+    def _escape_file(self, markdown_file_path: Path) -> list:
+        """Escape the Markdown file in place.
+
+        :param markdown_file_path: Path to the Markdown file
+
+        :returns: Sorted list of the hashes of the ``<escaped>`` tags emitted into the file
+        """
+
+        self.logger.debug(f'Processing the file: {markdown_file_path}')
+
+        with open(markdown_file_path, encoding='utf8') as markdown_file:
+            markdown_content = markdown_file.read()
+
+        processed_content = self._escape_file_content(markdown_file_path, markdown_content)
+
+        if not processed_content:
+            return []
+
+        with open(markdown_file_path, 'w', encoding='utf8') as markdown_file:
+            markdown_file.write(processed_content)
+
+        return sorted(set(ESCAPED_HASH_PATTERN.findall(processed_content)))
+
     def apply(self):
         self.logger.info('Applying preprocessor')
 
-        for markdown_file_path in self.working_dir.rglob('*.md'):
-            self.logger.debug(f'Processing the file: {markdown_file_path}')
-
-            with open(markdown_file_path, encoding='utf8') as markdown_file:
-                markdown_content = markdown_file.read()
-
-            if markdown_content.startswith('---') or markdown_content.startswith('+++'):
-                def _sub_frontmatter(m):
-                    return m.group(3)
-                def _sub_content(m):
-                    return m.group(6)
-                def _sub_format(m):
-                    return m.group(1)
-                frontmatter = self.frontmatter_pattern.sub(_sub_frontmatter, markdown_content)
-                content = self.frontmatter_pattern.sub(_sub_content, markdown_content)
-                format = self.frontmatter_pattern.sub(_sub_format, markdown_content)
-                for action in self.options.get('actions', []):
-                    if type(action) == dict:
-                        for escape_action in action['escape']:
-                            if escape_action == 'frontmatter':
-                                frontmatter = self.escape_for_raw_type(frontmatter, 'fence_blocks')
-                markdown_content = f"{format}\n" + frontmatter + f"\n{format}\n" + self.escape(content)
-            else:
-                markdown_content = self.escape(markdown_content)
+        if self.options.get('daemon'):
+            from foliant.preprocessors._escapecode_daemon import request_daemon
+
+            if request_daemon(self, 'escape'):
+                self.logger.info('Preprocessor applied')
+
+                return
+
+        markdown_file_paths = list(self.working_dir.rglob('*.md'))
 
-            processed_content = markdown_content
+        manifest = {
+            markdown_file_path.relative_to(self.working_dir).as_posix(): emitted_hashes
+            for markdown_file_path, emitted_hashes in zip(
+                markdown_file_paths,
+                map_files(self, self._escape_file, markdown_file_paths)
+            )
+            if emitted_hashes
+        }
 
-            if processed_content:
-                with open(markdown_file_path, 'w', encoding='utf8') as markdown_file:
-                    markdown_file.write(processed_content)
+        self._write_manifest(manifest)
 
         self.logger.info('Preprocessor applied')
 
 
-class FoliantMarkdown(Markdown):
-    def render(self, foliant_obj) -> str:
-        """Call ``self.renderer.render(text)``.
-        Override this to handle the parsed result.
-        """
-        self.renderer.foliant_obj = foliant_obj
-        parsed = foliant_obj.content
-        self.renderer.root_node = parsed
-        with self.renderer as r:
-            return r.render(parsed)
-
-
-marko.Markdown = FoliantMarkdown
-
-
-class HTMLBlock(block.HTMLBlock):
-
-    def __init__(self, lines: str) -> None:
-        self.children = lines
-        self.id = self.id
-
-    @classmethod
-    def match(cls, source: Source) -> int or bool:
-        if source.expect_re(r"(?i) {,3}<(script|pre|style|textarea)[>\s]"):
-            assert source.match
-            cls._end_cond = re.compile(rf"(?i)</{source.match.group(1)}>")
-            cls.id = 1
-            return 1
-        if source.expect_re(r" {,3}<!--"):
-            cls._end_cond = re.compile(r"-->")
-            cls.id = 2
-            return 2
-        if source.expect_re(r" {,3}<\?"):
-            cls._end_cond = re.compile(r"\?>")
-            cls.id = 3
-            return 3
-        if source.expect_re(r" {,3}<!"):
-            cls._end_cond = re.compile(r">")
-            cls.id = 4
-            return 4
-        if source.expect_re(r" {,3}<!\[CDATA\["):
-            cls._end_cond = re.compile(r"]]>")
-            cls.id = 5
-            return 5
-        block_tag = r"(?:{})".format("|".join(patterns.tags))
-        if source.expect_re(r"(?im) {,3}</?%s(?: +|/?>|$)" % block_tag):
-            cls._end_cond = None
-            cls.id = 6
-            return 6
-        if source.expect_re(
-            r"(?m) {,3}(<%(tag)s(?:%(attr)s)*[^\n\S]*/?>|</%(tag)s[^\n\S]*>)[^\n\S]*$"
-            % {"tag": patterns.tag_name, "attr": patterns.attribute_no_lf}
-        ):
-            cls._end_cond = None
-            cls.id = 7
-            return 7
-
-        return False
-
-block.HTMLBlock = HTMLBlock
-
-class EscapeCodeMarkdownRenderer(MarkdownRenderer):
-    def __init__(self):
-        super().__init__()
-        self._prefix = None
+def __getattr__(name):
+    # Backward compatibility: these names used to be defined in this module.
+    if name in ('FoliantMarkdown', 'HTMLBlock', 'EscapeCodeMarkdownRenderer'):
+        from foliant.preprocessors import _escapecode_marko
 
-    @staticmethod
-    def _check_options(raw_type: str, actions) -> bool:
-        if actions:
-            for action in actions:
-                if type(action) == dict:
-                    for escape_action in action['escape']:
-                        if escape_action == raw_type:
-                            return True
-        return False
-
-    def render_setext_heading(self, element: block.SetextHeading) -> str:
-        result = self._prefix + self.render_children(element)
-        self._prefix = self._second_prefix
-        return result
-
-    def render_code_block(self, element: block.CodeBlock) -> str:
-        foliant_obj = self.foliant_obj
-        indent = " " * 4; raw_type = 'pre_blocks'
-        exclude = False
-        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
-        lines = self.render_children(element).splitlines()
-        pattern = foliant_obj.options.get('pattern_override', {}).get(raw_type, '')
-        if run_escapecode:
-            for i, line in enumerate(lines):
-                indent = " " * 4
-                if line.startswith(" "):
-                    indent = " " * (4 + len(re.search(r'^ +', line).group(0)))
-                if pattern: exclude = re.compile(pattern).search(line)
-                if exclude or re.search(r'\s<escaped*></escaped>', line) or re.search(foliant_obj.pre_blocks_pattern, line):
-                    lines[i] = indent + line.strip()
-                elif line.strip() == "":
-                    lines[i] = line.strip()
-                else:
-                    lines[i] = indent + foliant_obj.escape_for_raw_type(line.strip(), raw_type)
-            indent = ''
-        lines = [self._prefix + indent + lines[0]] + [
-            self._second_prefix + indent + line for line in lines[1:]
-        ]
-        self._prefix = self._second_prefix
-        return "\n".join(lines) + "\n"
-
-    def render_fenced_code(self, element: block.FencedCode) -> str:
-        foliant_obj = self.foliant_obj
-        raw_type = 'fence_blocks'
-        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
-        extra = f" {element.extra}" if element.extra else ""
-        first_line = f"```{element.lang}{extra}"
-        if run_escapecode:
-            first_line = foliant_obj.escape_for_raw_type(first_line, raw_type)
-        lines = [first_line]
-        for line in self.render_children(element).splitlines():
-            if line.strip() != "":
-                lines.append(self._second_prefix + line)
-            else:
-                lines.append(line)
-        last_line = self._second_prefix + "```"
-        lines.append(last_line)
-        code_block = "\n".join(lines)
-        if run_escapecode:
-            if not re.search(r'<escaped*></escaped>', code_block):
-                code_block = foliant_obj.escape_for_raw_type(code_block, raw_type)
-        self._prefix = self._second_prefix
-        return self._prefix + code_block + "\n"
-
-    def render_code_span(self, element: inline.CodeSpan) -> str:
-        text = element.children
-        foliant_obj = self.foliant_obj
-        raw_type = 'inline_code'
-        exclude = False
-        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
-        pattern = foliant_obj.options.get('pattern_override', {}).get(raw_type, '')
-        if run_escapecode:
-            if pattern: exclude = re.compile(pattern).search(text)
-            if exclude or re.search(r'<escaped*></escaped>', text):
-                text = text
-            else:
-                text = foliant_obj.escape_for_raw_type(text, raw_type)
-        if text and text[0] == "`" or text[-1] == "`":
-            return f"`` {text} ``"
-        return f"`{text}`"
-
-    def render_thematic_break(self, element: block.ThematicBreak) -> str:
-        result = self._prefix + "---\n"
-        self._prefix = self._second_prefix
-        return result
-
-    def render_list(self, element: block.List) -> str:
-        result = []
-        sep = ""
-        if element.ordered:
-            for num, child in enumerate(element.children, element.start):
-                with self.container(f"{num}. ", " " * (len(str(num)) + 2)):
-                    result.append(self.render(child))
-        else:
-            for child in element.children:
-                with self.container(f"{element.bullet} ", "  "):
-                    result.append(self.render(child))
-        self._prefix = self._second_prefix
-        for num, item in enumerate(result):
-            lines = item.split("\n")
-            result[num] = "\n".join(lines)
-        if not element.tight:
-            sep = f"{self._prefix}\n"
-        return sep.join(result)
-
-    def render_html_block(self, element: block.HTMLBlock) -> str:
-        children = element.children
-        raw_type = 'comments'
-        foliant_obj = self.foliant_obj
-        run_escapecode = self._check_options(raw_type, foliant_obj.options.get('actions', []))
-        exclude = False
-        pattern = foliant_obj.options.get('pattern_override', {}).get(raw_type, '')
-        if element.id == 2 and run_escapecode:
-            if pattern: exclude = re.compile(pattern).search(children)
-            if exclude or re.search(r'<escaped*></escaped>', children):
-                children = children
-            else:
-                children = foliant_obj.escape_for_raw_type(children, raw_type)
-        result = self._prefix + children + "\n"
-        self._prefix = self._second_prefix
-        return result
+        return getattr(_escapecode_marko, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -4,12 +4,18 @@ Unescapes raw content that is escaped by the
 ``escapecode`` preprocessor.
 """
 
+import json
 from pathlib import Path
-from typing import Dict
+from threading import local
+from typing import Dict, Iterable
 OptionValue = int or float or bool or str
 
 from foliant.utils import output
 from foliant.preprocessors.base import BasePreprocessor
+from foliant.preprocessors.escapecode import (
+    ESCAPED_HASH_PATTERN, profile_file, map_files, get_manifest_path,
+    get_cache_layer_paths, index_cache_layers
+)
 
 
 class Preprocessor(BasePreprocessor):
@@ -22,12 +28,126 @@ class Preprocessor(BasePreprocessor):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._cache_dir_path = (self.project_path / self.options['cache_dir']).resolve()
+        self._cache_layer_paths = get_cache_layer_paths(self.project_path, self.options['cache_dir'])
+        self._cache_dir_path = self._cache_layer_paths[0]
+        self._fragment_index = None
+        self._local = local()
 
         self.logger = self.logger.getChild('unescapecode')
 
         self.logger.debug(f'Preprocessor inited: {self.__dict__}')
 
+    def _find_fragment(self, saved_content_hash: str) -> Path or None:
+        """Find the cache layer that contains the fragment. The layers are indexed
+        once per run; the fragments saved after that, e.g. by other preprocessors
+        that call ``escapecode``, are looked up in the layers in order.
+
+        :param saved_content_hash: Hash of the raw content
+
+        :returns: Path to the cache layer, or ``None`` if no layer contains the fragment
+        """
+
+        if self._fragment_index is None:
+            self.logger.debug('Indexing the cache layers')
+
+            self._fragment_index = index_cache_layers(self._cache_layer_paths)
+
+        cache_layer_path = self._fragment_index.get(saved_content_hash)
+
+        if cache_layer_path is None:
+            cache_layer_path = next(
+                (
+                    cache_layer_path for cache_layer_path in self._cache_layer_paths
+                    if (cache_layer_path / f'{saved_content_hash}.md').exists()
+                ),
+                None
+            )
+
+            if cache_layer_path is not None:
+                self._fragment_index[saved_content_hash] = cache_layer_path
+
+        return cache_layer_path
+
+    def _reset_fragment_index(self) -> None:
+        """Drop the index of the cache layers, so it is built again on the next lookup."""
+
+        self._fragment_index = None
+
+    def _get_fragments(self) -> Dict[str, str]:
+        """Get the in-memory cache of fragments for the file being processed
+        in the current thread. The cache is released after the file is written,
+        so memory does not grow with the project. Outside of file processing,
+        fragments are not cached.
+
+        :returns: Mapping from hashes to raw content
+        """
+
+        fragments = getattr(self._local, 'fragments', None)
+
+        return {} if fragments is None else fragments
+
+    def _load_fragment(self, saved_content_hash: str) -> str or None:
+        """Get the saved raw content by its hash. Fragments are read
+        from the cache layers once per file.
+
+        :param saved_content_hash: Hash of the raw content
+
+        :returns: Raw content, or ``None`` if no layer contains the file
+        """
+
+        fragments = self._get_fragments()
+
+        if saved_content_hash in fragments:
+            return fragments[saved_content_hash]
+
+        cache_layer_path = self._find_fragment(saved_content_hash)
+
+        if cache_layer_path is None:
+            return None
+
+        saved_content_file_path = cache_layer_path / f'{saved_content_hash}.md'
+
+        self.logger.debug(f'Restoring raw content from the file: {saved_content_file_path}')
+
+        try:
+            with open(saved_content_file_path, encoding='utf8') as saved_content_file:
+                fragments[saved_content_hash] = saved_content_file.read()
+
+        except FileNotFoundError:
+            self.logger.debug('File was removed after indexing, looking it up again')
+
+            self._fragment_index.pop(saved_content_hash, None)
+
+            return self._load_fragment(saved_content_hash)
+
+        return fragments[saved_content_hash]
+
+    def _preload_fragments(self, saved_content_hashes: Iterable[str]) -> None:
+        """Read the fragments that are referenced by a file before processing it.
+
+        :param saved_content_hashes: Hashes of the raw content
+        """
+
+        for saved_content_hash in saved_content_hashes:
+            self._load_fragment(saved_content_hash)
+
+    def _read_manifest(self) -> Dict[str, list]:
+        """Read the hashes emitted by the ``escapecode`` preprocessor into each file.
+
+        :returns: Mapping from file paths relative to the working directory
+            to the lists of hashes; empty if the manifest does not exist
+        """
+
+        manifest_file_path = get_manifest_path(self._cache_dir_path, self.working_dir)
+
+        if not manifest_file_path.exists():
+            self.logger.debug('Manifest not found, all files will be checked')
+
+            return {}
+
+        with open(manifest_file_path, encoding='utf8') as manifest_file:
+            return json.load(manifest_file)
+
     def _unescape(self, options: Dict[str, OptionValue], full_tag: str) -> str:
         """Replace the ``<escaped>`` tag with the content of the corresponding file.
 
@@ -41,14 +161,9 @@ class Preprocessor(BasePreprocessor):
 
         saved_content_hash = options.get('hash', '')
 
-        saved_content_file_path = self._cache_dir_path / f'{saved_content_hash}.md'
-
-        self.logger.debug(f'Restoring raw content from the file: {saved_content_file_path}')
-
-        if saved_content_file_path.exists():
-            with open(saved_content_file_path, encoding='utf8') as saved_content_file:
-                saved_content = saved_content_file.read()
+        saved_content = self._load_fragment(saved_content_hash)
 
+        if saved_content is not None:
             if self.pattern.search(saved_content):
                 self.logger.debug('Recursive call of the <escaped> tags processing')
 
@@ -82,19 +197,85 @@ class Preprocessor(BasePreprocessor):
 
         return markdown_content
 
+    def _unescape_file(self, markdown_file_path: Path, emitted_hashes: list or None) -> None:
+        """Restore the escaped content parts in the Markdown file in place.
+
+        :param markdown_file_path: Path to the Markdown file
+        :param emitted_hashes: Hashes that the ``escapecode`` preprocessor emitted
+            into the file, or ``None`` if the file is not listed in the manifest
+        """
+
+        self.logger.debug(f'Processing the file: {markdown_file_path}')
+
+        with open(markdown_file_path, encoding='utf8') as markdown_file:
+            markdown_content = markdown_file.read()
+
+        self._local.fragments = {}
+
+        try:
+            self._unescape_content(markdown_file_path, markdown_content, emitted_hashes)
+
+        finally:
+            self._local.fragments = None
+
+    def _unescape_content(self, markdown_file_path: Path, markdown_content: str, emitted_hashes: list or None):
+        """Restore the escaped content parts in the content of the Markdown file
+        and write the result into the file.
+
+        :param markdown_file_path: Path to the Markdown file
+        :param markdown_content: Content of the Markdown file
+        :param emitted_hashes: Hashes that the ``escapecode`` preprocessor emitted
+            into the file, or ``None`` if the file is not listed in the manifest
+        """
+
+        if emitted_hashes:
+            self._preload_fragments(emitted_hashes)
+
+            dropped_hashes = set(emitted_hashes) - set(ESCAPED_HASH_PATTERN.findall(markdown_content))
+
+            if dropped_hashes:
+                self.logger.warning(
+                    f'Escaped content parts were dropped from the file {markdown_file_path}, ' +
+                    f'hashes: {", ".join(sorted(dropped_hashes))}'
+                )
+
+        elif '<escaped' not in markdown_content:
+            self.logger.debug('No escaped content parts, skipping')
+
+            return
+
+        with profile_file(self, markdown_file_path, self._cache_dir_path, 'unescapecode'):
+            processed_content = self.unescape(markdown_content)
+
+        if processed_content:
+            with open(markdown_file_path, 'w', encoding='utf8') as markdown_file:
+                markdown_file.write(processed_content)
+
     def apply(self):
         self.logger.info('Applying preprocessor')
 
-        for markdown_file_path in self.working_dir.rglob('*.md'):
-            self.logger.debug(f'Processing the file: {markdown_file_path}')
+        if self.options.get('daemon'):
+            from foliant.preprocessors._escapecode_daemon import request_daemon
 
-            with open(markdown_file_path, encoding='utf8') as markdown_file:
-                markdown_content = markdown_file.read()
+            if request_daemon(self, 'unescape'):
+                self.logger.info('Preprocessor applied')
 
-            processed_content = self.unescape(markdown_content)
+                return
+
+        self._reset_fragment_index()
+
+        manifest = self._read_manifest()
+
+        def _unescape_file(markdown_file_path: Path) -> None:
+            return self._unescape_file(
+                markdown_file_path,
+                manifest.get(markdown_file_path.relative_to(self.working_dir).as_posix())
+            )
+
+        map_files(self, _unescape_file, list(self.working_dir.rglob('*.md')))
+
+        self.logger.debug('Removing the manifest')
 
-            if processed_content:
-                with open(markdown_file_path, 'w', encoding='utf8') as markdown_file:
-                    markdown_file.write(processed_content)
+        get_manifest_path(self._cache_dir_path, self.working_dir).unlink(missing_ok=True)
 
         self.logger.info('Preprocessor applied')
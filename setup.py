@@ -16,11 +16,11 @@ setup(
     description=SHORT_DESCRIPTION,
     long_description=LONG_DESCRIPTION,
     long_description_content_type='text/markdown',
-    version='1.0.9',
+    version='1.1.0',
     author='Artemy Lomov',
     author_email='artemy@lomov.ru',
     url='https://github.com/foliant-docs/foliantcontrib.escapecode',
-    packages=['foliant.preprocessors'],
+    packages=['foliant.preprocessors', 'foliant.cli'],
     license='MIT',
     platforms='any',
     install_requires=[
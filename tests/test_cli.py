@@ -0,0 +1,65 @@
+import os
+import socket
+
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from foliant.cli.escapecode import Cli
+
+def rel_name(path:str):
+    return os.path.join(os.path.dirname(__file__), path)
+
+def data_file_content(path: str) -> str:
+    '''read data file by path relative to this module and return its contents'''
+    with open(rel_name(path), encoding='utf8') as f:
+        return f.read()
+
+class TestEscapecodeCli(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.source_dir = Path(self.tmp_dir.name) / 'src'
+        self.cache_dir = Path(self.tmp_dir.name) / 'cache'
+        self.source_dir.mkdir()
+        self.content = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        for name in ('index.md', 'chapter.md'):
+            with open(self.source_dir / name, 'w', encoding='utf8') as f:
+                f.write(self.content)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_cli(self, *args, **kwargs) -> str:
+        stdout = StringIO()
+        with redirect_stdout(stdout):
+            Cli().escapecode(*args, source_dir=self.source_dir, cache_dir=str(self.cache_dir), **kwargs)
+        return stdout.getvalue()
+
+    def test_stats(self):
+        report = self.run_cli('escape', stats=True, workers=2)
+        self.assertIn('index.md: 6 fragments (5 unique), 622 bytes', report)
+        self.assertIn('Projected cache size: 5 new files, 619 bytes', report)
+        self.assertFalse(self.cache_dir.exists())
+        self.assertEqual((self.source_dir / 'index.md').read_text(encoding='utf8'), self.content)
+
+    def test_prime_cache(self):
+        self.run_cli('escape', prime_cache=True)
+        self.assertEqual(len(list(self.cache_dir.glob('*.md'))), 5)
+        self.assertEqual((self.source_dir / 'index.md').read_text(encoding='utf8'), self.content)
+
+    def test_escape_and_unescape(self):
+        self.run_cli('escape', workers=2)
+        self.assertIn('<escaped hash=', (self.source_dir / 'index.md').read_text(encoding='utf8'))
+        self.run_cli('unescape', workers=2)
+        self.assertNotIn('<escaped hash=', (self.source_dir / 'index.md').read_text(encoding='utf8'))
+
+    def test_daemon_already_running(self):
+        socket_path = Path(self.tmp_dir.name) / 'escapecode.sock'
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(str(socket_path))
+            server.listen()
+            with self.assertRaises(SystemExit):
+                Cli().escapecode_daemon(socket_path=socket_path, quiet=True)
+            self.assertTrue(socket_path.exists())
@@ -0,0 +1,180 @@
+import os
+import re
+import socket
+
+from logging import getLogger
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+
+from foliant.preprocessors import escapecode, unescapecode
+from foliant.preprocessors._escapecode_daemon import EscapeCodeDaemon, is_daemon_running
+
+def rel_name(path:str):
+    return os.path.join(os.path.dirname(__file__), path)
+
+def data_file_content(path: str) -> str:
+    '''read data file by path relative to this module and return its contents'''
+    with open(rel_name(path), encoding='utf8') as f:
+        return f.read()
+
+class TestEscapecodeDaemon(TestCase):
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.project_path = Path(self.tmp_dir.name)
+        self.working_dir = self.project_path / '__folianttmp__'
+        self.working_dir.mkdir()
+        self.context = {
+            'project_path': self.project_path,
+            'config': {'tmp_dir': '__folianttmp__'}
+        }
+        self.logger = getLogger('TestEscapecodeDaemon')
+        self.options = {'daemon': 'escapecode.sock'}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_source(self, name: str) -> str:
+        content = data_file_content(os.path.join('data', 'input', f'{name}.md'))
+        (self.working_dir / f'{name}.md').write_text(content, encoding='utf8')
+        return content
+
+    def read_result(self, name: str) -> str:
+        return re.sub(r' +\n', '\n', (self.working_dir / f'{name}.md').read_text(encoding='utf8'))
+
+    def test_escape_and_unescape(self):
+        daemon = EscapeCodeDaemon(self.project_path / 'escapecode.sock', self.logger)
+        thread = Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            for _ in range(2):
+                self.write_source('fence_blocks')
+                escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+                self.assertEqual(
+                    self.read_result('fence_blocks'),
+                    data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+                )
+            unescapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+            self.assertNotIn('<escaped', self.read_result('fence_blocks'))
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+
+    def test_index_kept_between_rebuilds(self):
+        daemon = EscapeCodeDaemon(self.project_path / 'escapecode.sock', self.logger)
+        thread = Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            with self.assertLogs(self.logger, level='DEBUG') as logs:
+                for _ in range(3):
+                    self.write_source('fence_blocks')
+                    escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+                    unescapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+                    self.assertNotIn('<escaped', self.read_result('fence_blocks'))
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+        messages = [record.getMessage() for record in logs.records]
+        self.assertFalse([message for message in messages if 'rebuilding the fragment index' in message])
+        self.assertEqual(messages.count('Indexing the cache layers'), 1)
+
+    def test_results_kept_per_file(self):
+        daemon = EscapeCodeDaemon(self.project_path / 'escapecode.sock', self.logger)
+        thread = Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            with self.assertLogs(self.logger, level='DEBUG') as logs:
+                for content in ('Edit `one`.\n', 'Edit `two`.\n', 'Edit `two`.\n'):
+                    (self.working_dir / 'index.md').write_text(content, encoding='utf8')
+                    escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+            preprocessor, = daemon.preprocessors.values()
+            self.assertEqual(list(preprocessor._results.keys()), ['index.md'])
+            self.assertEqual(
+                [record.getMessage() for record in logs.records].count('File not changed, using the previous result'),
+                1
+            )
+            (self.working_dir / 'index.md').unlink()
+            escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+            self.assertEqual(preprocessor._results, {})
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+
+    def test_lean_memory(self):
+        self.options['lean_memory'] = True
+        daemon = EscapeCodeDaemon(self.project_path / 'escapecode.sock', self.logger)
+        thread = Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            for _ in range(2):
+                self.write_source('fence_blocks')
+                escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+                self.assertEqual(
+                    self.read_result('fence_blocks'),
+                    data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+                )
+            preprocessor, = daemon.preprocessors.values()
+            self.assertEqual(preprocessor._results, {})
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+
+    def test_fallback_without_daemon(self):
+        self.write_source('fence_blocks')
+        with self.assertLogs(self.logger, level='WARNING'):
+            escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+        self.assertEqual(
+            self.read_result('fence_blocks'),
+            data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        )
+
+    def test_profile_dump(self):
+        self.options['profile'] = {'threshold': 0, 'dump': True}
+        daemon = EscapeCodeDaemon(self.project_path / 'escapecode.sock', self.logger)
+        thread = Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            self.write_source('fence_blocks')
+            escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+            unescapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+        profiles_path = self.project_path / '.escapecodecache' / 'profiles'
+        for profile_name in ('escapecode', 'unescapecode'):
+            self.assertTrue((profiles_path / profile_name / 'fence_blocks.md.pstats').exists())
+
+    def test_fallback_on_timeout(self):
+        self.options['daemon_timeout'] = 0.1
+        self.write_source('fence_blocks')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            # Accepts connections but never responds
+            server.bind(str(self.project_path / 'escapecode.sock'))
+            server.listen()
+            with self.assertLogs(self.logger, level='WARNING') as logs:
+                escapecode.Preprocessor(self.context, self.logger, options=self.options).apply()
+        self.assertIn('timed out', logs.output[0])
+        self.assertEqual(
+            self.read_result('fence_blocks'),
+            data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        )
+
+    def test_stale_socket(self):
+        socket_path = self.project_path / 'escapecode.sock'
+        daemon = EscapeCodeDaemon(socket_path, self.logger)
+        thread = Thread(target=daemon.serve_forever)
+        thread.start()
+        try:
+            self.assertTrue(is_daemon_running(socket_path))
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+        self.assertTrue(socket_path.exists())
+        self.assertFalse(is_daemon_running(socket_path))
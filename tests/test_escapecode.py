@@ -1,7 +1,15 @@
 import os
+import re
+import json
+import shutil
+import subprocess
+import sys
+import gc
+import weakref
 
 from pathlib import Path
 from foliant_test.preprocessor import PreprocessorTestFramework
+from foliant.preprocessors import escapecode
 from unittest import TestCase
 
 def rel_name(path:str):
@@ -85,6 +93,18 @@ class TestEscapecode(TestCase):
             }
         )
 
+    def test_nested_lists(self):
+        content = data_file_content(os.path.join('data', 'input', 'nested_lists.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'nested_lists.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+
     def test_normalize(self):
         self.ptf.test_preprocessor(
             input_mapping = {
@@ -95,6 +115,16 @@ class TestEscapecode(TestCase):
             }
         )
 
+    def test_frontmatter_unclosed(self):
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': '---\n\nText with `inline code`.\n'
+            },
+            expected_mapping = {
+                'index.md': '---\n\nText with `<escaped hash="17c3d4fb075d05370d828e0915b7335a"></escaped>`.\n'
+            }
+        )
+
     def test_tags(self):
         self.ptf.options =  {
             'cache_dir': Path('.escapecodecache'),
@@ -177,3 +207,179 @@ class TestEscapecode(TestCase):
                 'index.md': content_with_hash
             }
         )
+
+    def test_pre_blocks_granularity(self):
+        self.ptf.options['granularity'] = {'pre_blocks': 'block'}
+        content = data_file_content(os.path.join('data', 'input', 'pre_blocks.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'pre_blocks_granularity.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+
+    def test_pre_blocks_granularity_pattern_override(self):
+        self.ptf.options['granularity'] = {'pre_blocks': 'block'}
+        self.ptf.options['pattern_override'] = {
+            'pre_blocks': r'pattern_override_pre_block_code_\d+'
+        }
+        content = data_file_content(os.path.join('data', 'input', 'pattern_override.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'pre_blocks_granularity_pattern_override.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+
+    def test_pre_blocks_granularity_blank_lines(self):
+        self.ptf.options['granularity'] = {'pre_blocks': 'block'}
+        content = data_file_content(os.path.join('data', 'input', 'pre_blocks_blank_lines.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'pre_blocks_granularity_blank_lines.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+
+    def test_manifest(self):
+        content = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content,
+                'sub/plain.md': '# Plain text\n'
+            }
+        )
+        manifest_path = escapecode.get_manifest_path(Path('.escapecodecache'), self.ptf.context['config']['tmp_dir'])
+        with open(manifest_path, encoding='utf8') as f:
+            manifest = json.load(f)
+        self.assertEqual(list(manifest.keys()), ['index.md'])
+        self.assertEqual(manifest['index.md'], sorted(set(re.findall(r'hash="(\w+)"', content_with_hash))))
+
+    def test_profile(self):
+        self.ptf.options['profile'] = {'threshold': 0, 'dump': True}
+        content = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        with self.assertLogs(self.ptf.logger, level='WARNING') as logs:
+            self.ptf.test_preprocessor(
+                input_mapping = {
+                    'sub/index.md': content
+                }
+            )
+        self.assertIn('Slow file: sub/index.md', logs.output[0])
+        self.assertTrue((Path('.escapecodecache') / 'profiles' / 'escapecode' / 'sub' / 'index.md.pstats').exists())
+
+    def test_threads(self):
+        self.ptf.options['threads'] = 4
+        names = ['pre_blocks', 'fence_blocks', 'inline_code', 'comments', 'frontmatter_yaml']
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                f'{name}.md': data_file_content(os.path.join('data', 'input', f'{name}.md'))
+                for name in names
+            },
+            expected_mapping = {
+                f'{name}.md': data_file_content(os.path.join('data', 'expected', f'{name}.md'))
+                for name in names
+            }
+        )
+
+    def test_cache_layers(self):
+        content = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            }
+        )
+        self.ptf.options['cache_dir'] = [Path('.escapecodecache_top'), Path('.escapecodecache')]
+        try:
+            self.ptf.test_preprocessor(
+                input_mapping = {
+                    'index.md': content,
+                    'new.md': 'Text with `cache_layers_only_code`.\n'
+                },
+                expected_mapping = {
+                    'index.md': content_with_hash,
+                    'new.md': 'Text with `<escaped hash="256893ff6c61bfb2ddfb024f252bd21e"></escaped>`.\n'
+                }
+            )
+            self.assertEqual(
+                sorted(path.name for path in Path('.escapecodecache_top').iterdir()),
+                ['256893ff6c61bfb2ddfb024f252bd21e.md', 'manifests']
+            )
+            self.assertFalse((Path('.escapecodecache') / '256893ff6c61bfb2ddfb024f252bd21e.md').exists())
+        finally:
+            shutil.rmtree('.escapecodecache_top', ignore_errors=True)
+
+    def test_renderer_releases_document(self):
+        preprocessor = escapecode.Preprocessor(
+            {'project_path': Path('.'), 'config': {'tmp_dir': '__folianttmp__'}},
+            self.ptf.logger,
+            options=self.ptf.options
+        )
+        import marko.inline
+        markdown = preprocessor._get_markdown()
+        document = markdown.parse(data_file_content(os.path.join('data', 'input', 'nested_lists.md')))
+        markdown.render(document, preprocessor)
+        self.assertIsNone(markdown.renderer.root_node)
+        self.assertIsNone(markdown.renderer.foliant_obj)
+        self.assertIsNot(marko.inline._root_node, document)
+        document = weakref.ref(document)
+        gc.collect()
+        self.assertIsNone(document())
+
+    def test_parser_overrides_do_not_leak(self):
+        import marko
+        from foliant.preprocessors._escapecode_marko import HTMLBlock
+        markdown = marko.Markdown()
+        markdown.parse('text\n')
+        preprocessor = escapecode.Preprocessor(
+            {'project_path': Path('.'), 'config': {'tmp_dir': '__folianttmp__'}},
+            self.ptf.logger,
+            options=self.ptf.options
+        )
+        preprocessor.escape('text\n')
+        quote = markdown.parse('> <!-- c -->\n').children[0]
+        self.assertNotIsInstance(quote.children[0], HTMLBlock)
+
+    def test_parsing_in_parallel(self):
+        from concurrent.futures import ThreadPoolExecutor
+        preprocessor = escapecode.Preprocessor(
+            {'project_path': Path('.'), 'config': {'tmp_dir': '__folianttmp__'}},
+            self.ptf.logger,
+            options=self.ptf.options
+        )
+        names = ['nested_lists', 'fence_blocks', 'comments', 'pre_blocks', 'inline_code']
+        contents = [
+            data_file_content(os.path.join('data', 'input', f'{name}.md')) + '\n[link][ref]\n\n[ref]: /url\n'
+            for name in names
+        ] * 20
+        expected = [preprocessor.escape(content) for content in contents]
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(4) as executor:
+                self.assertEqual(list(executor.map(preprocessor.escape, contents)), expected)
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+    def test_marko_is_imported_lazily(self):
+        result = subprocess.run(
+            [
+                sys.executable, '-c',
+                'import sys, foliant.preprocessors.escapecode; ' +
+                'print("marko" in sys.modules, "concurrent.futures" in sys.modules)'
+            ],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True
+        )
+        self.assertEqual(result.stdout.strip(), 'False False')
@@ -1,7 +1,10 @@
 import os
+import json
+import shutil
 
 from pathlib import Path
 from foliant_test.preprocessor import PreprocessorTestFramework
+from foliant.preprocessors import escapecode, unescapecode
 from unittest import TestCase
 
 def rel_name(path:str):
@@ -129,3 +132,123 @@ class TestUnescapecode(TestCase):
                 'index.md': content_with_hash
             }
         )
+
+    def test_pre_blocks_granularity(self):
+        content = data_file_content(os.path.join('data', 'expected', 'pre_blocks_granularity.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'input', 'pre_blocks.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+
+    def test_pre_blocks_granularity_pattern_override(self):
+        content = data_file_content(os.path.join('data', 'expected', 'pre_blocks_granularity_pattern_override.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'input', 'pattern_override.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+
+    def test_pre_blocks_granularity_blank_lines(self):
+        content = data_file_content(os.path.join('data', 'input', 'pre_blocks_blank_lines.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'expected', 'pre_blocks_granularity_blank_lines.md'))
+        context = {'project_path': Path('.'), 'config': {'tmp_dir': '__folianttmp__'}}
+        escaped_by_line = escapecode.Preprocessor(context, self.ptf.logger).escape(content)
+        unescape = unescapecode.Preprocessor(context, self.ptf.logger).unescape
+        self.assertEqual(unescape(content_with_hash), unescape(escaped_by_line))
+
+    def test_threads(self):
+        self.ptf.options = {'threads': 4}
+        names = ['pre_blocks', 'fence_blocks', 'inline_code', 'comments', 'frontmatter_yaml']
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                f'{name}.md': data_file_content(os.path.join('data', 'expected', f'{name}.md'))
+                for name in names
+            },
+            expected_mapping = {
+                f'{name}.md': data_file_content(os.path.join('data', 'input', f'{name}.md'))
+                for name in names
+            }
+        )
+
+    def test_manifest_dropped_hashes(self):
+        content = data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        manifest_path = escapecode.get_manifest_path(Path('.escapecodecache'), self.ptf.context['config']['tmp_dir'])
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, 'w', encoding='utf8') as f:
+            json.dump({'index.md': ['0' * 32]}, f)
+        with self.assertLogs(self.ptf.logger, level='WARNING') as logs:
+            self.ptf.test_preprocessor(
+                input_mapping = {
+                    'index.md': content
+                }
+            )
+        self.assertIn('0' * 32, logs.output[0])
+        self.assertFalse(manifest_path.exists())
+
+    def test_manifest_empty_or_missing(self):
+        content = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        manifest_path = escapecode.get_manifest_path(Path('.escapecodecache'), self.ptf.context['config']['tmp_dir'])
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, 'w', encoding='utf8') as f:
+            json.dump({}, f)
+        for _ in range(2):
+            self.ptf.test_preprocessor(
+                input_mapping = {
+                    'index.md': content
+                },
+                expected_mapping = {
+                    'index.md': content
+                }
+            )
+            self.assertFalse(manifest_path.exists())
+
+    def test_fragments_released_after_each_file(self):
+        content = data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        context = {'project_path': Path('.'), 'config': {'tmp_dir': '__folianttmp_fragments__'}}
+        preprocessor = unescapecode.Preprocessor(context, self.ptf.logger)
+        fragment_caches = []
+        unescape_content = preprocessor._unescape_content
+        def _unescape_content(*args):
+            unescape_content(*args)
+            fragment_caches.append(preprocessor._local.fragments)
+        preprocessor._unescape_content = _unescape_content
+        try:
+            preprocessor.working_dir.mkdir(parents=True)
+            for name in ('first.md', 'second.md'):
+                with open(preprocessor.working_dir / name, 'w', encoding='utf8') as f:
+                    f.write(content)
+            preprocessor.apply()
+            with open(preprocessor.working_dir / 'second.md', encoding='utf8') as f:
+                self.assertEqual(f.read(), content_with_hash)
+        finally:
+            shutil.rmtree('__folianttmp_fragments__', ignore_errors=True)
+        self.assertEqual(len(fragment_caches), 2)
+        self.assertTrue(fragment_caches[0])
+        self.assertEqual(fragment_caches[0], fragment_caches[1])
+        self.assertIsNot(fragment_caches[0], fragment_caches[1])
+        self.assertIsNone(preprocessor._local.fragments)
+        self.assertFalse(hasattr(preprocessor, '_fragments'))
+
+    def test_cache_layers(self):
+        self.ptf.options = {'cache_dir': [Path('.escapecodecache_top'), Path('.escapecodecache')]}
+        content = data_file_content(os.path.join('data', 'expected', 'fence_blocks.md'))
+        content_with_hash = data_file_content(os.path.join('data', 'input', 'fence_blocks.md'))
+        self.ptf.test_preprocessor(
+            input_mapping = {
+                'index.md': content
+            },
+            expected_mapping = {
+                'index.md': content_with_hash
+            }
+        )
+        self.assertFalse(Path('.escapecodecache_top').exists())